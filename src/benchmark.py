@@ -0,0 +1,354 @@
+from __future__ import annotations
+import os, sys, gc, ast, json, time, random, platform, tempfile, multiprocessing
+import pickle as pk
+from pathlib import Path
+from typing import List, Dict, Tuple
+from collections import defaultdict
+from argparse import ArgumentParser
+import dataprocess as dp
+from store import CompiledStore, load_store
+from pinyin import build_model
+
+ROOT = Path(__file__).parent.parent
+
+# 名称 -> (模型类型, compiled, 量化位数)
+MODELS: Dict[str, Tuple[int, bool, int]] = {
+    "binary": (2, False, 0),
+    "triple": (3, False, 0),
+    "compiled_binary": (2, True, 0),
+    "compiled_triple": (3, True, 0),
+    "compiled_triple_q8": (3, True, 8),
+}
+LENGTH_BUCKETS = [(1, 4), (5, 8), (9, 12), (13, 16), (17, 1 << 30)]
+
+def rss_bytes() -> int:
+    # 当前常驻内存；没有 /proc 的平台退回到峰值常驻内存
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        scale = 1 if sys.platform == "darwin" else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+def distribution(latencies: List[float]) -> Dict[str, float]:
+    # 延迟分布（毫秒）
+    latencies = sorted(latencies)
+    if not latencies:
+        return {"count": 0}
+    percentile = lambda p: latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+    return {"count": len(latencies), "mean_ms": sum(latencies) / len(latencies) * 1000, "p50_ms": percentile(0.5), \
+            "p90_ms": percentile(0.9), "p99_ms": percentile(0.99), "max_ms": latencies[-1] * 1000}
+
+def make_corpus(path: Path, lines: int, seed: int) -> int:
+    '''
+    生成与 sina_news_gbk 同格式的合成语料（JSON lines，gbk 编码，title / html 两个键）：
+    句子取自 data/std_output.txt，并夹杂从一二级汉字表中随机抽取的噪声字。返回语料中的总字数
+    '''
+    rng = random.Random(seed)
+    with open(ROOT / "data" / "std_output.txt", "r", encoding="utf8") as f:
+        sentences = [line.strip() for line in f if line.strip()]
+    with open(ROOT / "table" / "一二级汉字表.txt", "r", encoding="gbk") as f:
+        chars = list(f.read().strip())
+    total = 0
+    with open(path, "w", encoding="gbk") as f:
+        for _ in range(lines):
+            title = rng.choice(sentences)
+            noise = "".join(rng.choice(chars) for _ in range(rng.randint(5, 30)))
+            html = noise + "，" + title + "。" + rng.choice(sentences)
+            total += len(title) + len(html)
+            f.write(json.dumps({"title": title, "html": html}, ensure_ascii=False) + "\n")
+    return total
+
+def table_chars() -> List[str]:
+    with open(ROOT / "table" / "一二级汉字表.txt", "r", encoding="gbk") as f:
+        return list(dict.fromkeys(f.read())) + ['<start>', '<end>']
+
+def legacy_freq_tables(file: Path, keys: List[str], encoding: str, char_table: Dict[str, int]) -> Tuple[dict, dict]:
+    '''
+    基线：改用单遍计数之前 dataprocess.py 的两遍构建（build_binary_freq_table + build_triple_freq_table），
+    每遍都用 ast.literal_eval 解析每一行、逐字查表计数。原样保留在这里作为 ingest 吞吐量的对照，只去掉了进度条与逐行的异常打印
+    '''
+    binary = defaultdict(lambda: defaultdict(lambda: 0))
+    with open(file, "r", encoding=encoding) as f:
+        for line in f.readlines():
+            data = ast.literal_eval(line)
+            for key in keys:
+                text = data.get(key, "")
+                if not text:
+                    continue
+                text = " " + text + " "
+                for i in range(len(text)-1):
+                    if text[i] in char_table:
+                        char_table[text[i]] += 1
+                    if text[i] in char_table and text[i+1] in char_table:
+                        binary[text[i]][text[i+1]] += 1
+                    if text[i] in dp.SEP and text[i+1] in char_table:
+                        binary['<start>'][text[i+1]] += 1
+                    if text[i] in char_table and text[i+1] in dp.SEP:
+                        binary[text[i]]['<end>'] += 1
+    triple = defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: 0)))
+    with open(file, "r", encoding=encoding) as f:
+        for line in f.readlines():
+            data = ast.literal_eval(line)
+            for key in keys:
+                text = data.get(key, "")
+                if not text:
+                    continue
+                text = " " + text + "  "
+                for i in range(len(text)-2):
+                    if text[i] in char_table and text[i+1] in char_table and text[i+2] in char_table:
+                        triple[text[i]][text[i+1]][text[i+2]] += 1
+                    if text[i] in dp.SEP and text[i+1] in char_table and text[i+2] in char_table:
+                        triple['<start>'][text[i+1]][text[i+2]] += 1
+                    if text[i] in char_table and text[i+1] in char_table and text[i+2] in dp.SEP:
+                        triple[text[i]][text[i+1]]['<end>'] += 1
+                    if text[i] in dp.SEP and text[i+1] in char_table and text[i+2] in dp.SEP:
+                        triple['<start>'][text[i+1]]['<end>'] += 1
+    return binary, triple
+
+def bench_ingest(corpus: Path, work_dir: Path, corpus_chars: int, workers: int) -> Dict[str, Dict[str, float]]:
+    '''
+    dataprocess.py 各构建方式的吞吐量（字/秒）。stream 方式构建出的 ngram_store.bin 同时作为后续测试用的合成表
+    '''
+    results = {}
+    chars = table_chars()
+    keys = ["title", "html"]
+
+    def record(name: str, seconds: float) -> None:
+        results[name] = {"seconds": seconds, "chars_per_sec": corpus_chars / seconds if seconds else 0.0}
+
+    start = time.perf_counter()
+    legacy_freq_tables(corpus, keys, "gbk", dict.fromkeys(chars[:-2], 0))
+    record("legacy", time.perf_counter() - start)
+
+    dp.CHAR_FREQ_TABLE.clear()
+    dp.CHAR_FREQ_TABLE.update(dict.fromkeys(chars[:-2], 0))
+    start = time.perf_counter()
+    dp.build_binary_freq_table(corpus, keys, "gbk", defaultdict(lambda: defaultdict(lambda: 0)))
+    dp.build_triple_freq_table(corpus, keys, "gbk", defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: 0))))
+    record("two_pass", time.perf_counter() - start)
+
+    ids = {c: i for i, c in enumerate(chars)}
+    start = time.perf_counter()
+    uni, bi, tri = defaultdict(int), defaultdict(int), defaultdict(int)
+    for text in dp.iter_corpus_texts(corpus, keys, "gbk"):
+        dp.count_ngrams(text, ids, uni, bi, tri)
+    record("single_pass", time.perf_counter() - start)
+
+    start = time.perf_counter()
+    uni, bi, tri = defaultdict(int), defaultdict(int), defaultdict(int)
+    counter = dp.RunCounter(chars, uni, bi, tri)
+    for text in dp.iter_corpus_texts(corpus, keys, "gbk"):
+        counter.add(text)
+    counter.flush()
+    record("runs", time.perf_counter() - start)
+
+    if workers > 1:
+        dp.CHAR_FREQ_TABLE.clear()
+        dp.CHAR_FREQ_TABLE.update(dict.fromkeys(chars[:-2], 0))
+        start = time.perf_counter()
+        dp.build_freq_tables_parallel([corpus], keys, "gbk", workers, work_dir / "shards", \
+                                      os.path.getsize(corpus) // (workers * 2) + 1)
+        record(f"parallel_{workers}", time.perf_counter() - start)
+
+    start = time.perf_counter()
+    unigram, bi_runs, tri_runs = dp.count_corpus_streaming([corpus], keys, "gbk", chars, work_dir / "spill", 1 << 20)
+    store, = dp.build_stores_from_runs(chars, unigram, [dp.run_stream(run) for run in bi_runs], \
+                                       [dp.run_stream(run) for run in tri_runs])
+    record("stream", time.perf_counter() - start)
+    store.save(work_dir / "ngram_store.bin")
+    return results
+
+def measure_load(name: str, data_path: Path, k: int, alpha: float, beta: float, total: int) -> Dict[str, float]:
+    # 在独立（spawn）进程中执行，避免父进程已加载的表影响常驻内存的测量
+    model_type, compiled, bits = MODELS[name]
+    gc.collect()
+    before = rss_bytes()
+    start = time.perf_counter()
+    model = build_model(model_type, k, alpha, beta, total, data_path, compiled, bits)
+    seconds = time.perf_counter() - start
+    after = rss_bytes()
+    return {"seconds": seconds, "rss_delta_mb": (after - before) / 2**20, "rss_mb": after / 2**20}
+
+def prepare_compiled(name: str, data_path: Path, alpha: float, beta: float, total: int) -> None:
+    # 为编译模型写出参数匹配的 compiled_store.bin，使加载时间测的是映射而不是现场编译
+    model_type, compiled, bits = MODELS[name]
+    if not compiled:
+        return
+    store = load_store(data_path, triple=model_type >= 3)
+    compiled_store = CompiledStore.compile(store, alpha, beta if model_type >= 3 else None, total)
+    (compiled_store.quantize(bits) if bits else compiled_store).save(data_path / "compiled_store.bin")
+
+def bench_decode(name: str, data_path: Path, sentences: List[List[str]], ks: List[int], alpha: float, beta: float, \
+                 total: int) -> Dict[str, Dict[str, Dict[str, float]]]:
+    model_type, compiled, bits = MODELS[name]
+    model = build_model(model_type, max(ks), alpha, beta, total, data_path, compiled, bits)
+    results = {}
+    for k in ks:
+        model.k = k
+        by_bucket: Dict[str, List[float]] = defaultdict(list)
+        latencies = []
+        for sentence in sentences:
+            model.reset()
+            start = time.perf_counter()
+            model.inference(sentence)
+            latency = time.perf_counter() - start
+            latencies.append(latency)
+            lo, hi = next(bucket for bucket in LENGTH_BUCKETS if bucket[0] <= len(sentence) <= bucket[1])
+            by_bucket[f"{lo}-{hi}" if hi < 1 << 30 else f"{lo}+"].append(latency)
+        results[f"k={k}"] = {"all": distribution(latencies)} | {bucket: distribution(values) for bucket, values in by_bucket.items()}
+    return results
+
+def flatten(tree: dict, prefix: str = "") -> Dict[str, float]:
+    items = {}
+    for key, value in tree.items():
+        if isinstance(value, dict):
+            items |= flatten(value, f"{prefix}{key}.")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            items[prefix + key] = value
+    return items
+
+def compare(report: dict, baseline: dict) -> None:
+    # 打印与上一次结果相比的变化（只比较两边都有的数值项）
+    new, old = flatten(report), flatten(baseline)
+    for key in sorted(new.keys() & old.keys()):
+        if key.startswith("meta.") or not old[key]:
+            continue
+        print(f"{key}: {old[key]:.4g} -> {new[key]:.4g} ({(new[key] / old[key] - 1) * 100:+.1f}%)")
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument(
+        "-o", "--output",
+        type=str,
+        dest="output",
+        help="JSON report path",
+        default="benchmark.json"
+    )
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        dest="baseline",
+        help="Previous JSON report to compare against",
+        default=""
+    )
+    parser.add_argument(
+        "--work-dir",
+        type=str,
+        dest="work_dir",
+        help="Keep the synthetic corpus and tables here (default: temp dir)",
+        default=""
+    )
+    parser.add_argument(
+        "--corpus-lines",
+        type=int,
+        dest="corpus_lines",
+        help="Lines of synthetic corpus",
+        default=2000
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        dest="seed",
+        help="Random seed of the synthetic corpus",
+        default=0
+    )
+    parser.add_argument(
+        "-i", "--input",
+        type=str,
+        dest="input",
+        help="Pinyin input for the decode benchmark",
+        default=str(ROOT / "data" / "input.txt")
+    )
+    parser.add_argument(
+        "-n", "--lines",
+        type=int,
+        dest="lines",
+        help="Decode the first n input lines (0: all)",
+        default=50
+    )
+    parser.add_argument(
+        "-k",
+        type=int,
+        nargs="+",
+        dest="ks",
+        help="Top k values to benchmark",
+        default=[1, 3, 5]
+    )
+    parser.add_argument(
+        "-m", "--models",
+        type=str,
+        nargs="+",
+        choices=list(MODELS),
+        dest="models",
+        help="Models to benchmark",
+        default=list(MODELS)
+    )
+    parser.add_argument(
+        "-w", "--workers",
+        type=int,
+        dest="workers",
+        help="Workers of the parallel ingest benchmark",
+        default=max(2, min(4, os.cpu_count() or 1))
+    )
+    parser.add_argument(
+        "-a", "--alpha",
+        type=float,
+        dest="alpha",
+        help="Smoothing factor in Binary Model",
+        default=0.99999
+    )
+    parser.add_argument(
+        "-b", "--beta",
+        type=float,
+        dest="beta",
+        help="Smoothing factor in Triple Model",
+        default=0.9
+    )
+    parser.add_argument(
+        "-t", "--total",
+        type=int,
+        dest="total",
+        help="Estimated total character number",
+        default=1000000
+    )
+    args = parser.parse_args()
+
+    temp_dir = None if args.work_dir else tempfile.TemporaryDirectory()
+    work_dir = Path(args.work_dir or temp_dir.name)
+    os.makedirs(work_dir, exist_ok=True)
+    report = {"meta": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(), \
+                       "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "args": vars(args)}}
+
+    corpus = work_dir / "corpus.txt"
+    corpus_chars = make_corpus(corpus, args.corpus_lines, args.seed)
+    report["corpus"] = {"lines": args.corpus_lines, "chars": corpus_chars, "bytes": os.path.getsize(corpus)}
+    print("Benchmarking ingest ...")
+    report["ingest"] = bench_ingest(corpus, work_dir, corpus_chars, args.workers)
+    pinyin_table = dp.build_pinyin_table(ROOT / "table" / "拼音汉字表.txt")
+    pinyin_table['<end>'] = ['<end>']
+    with open(work_dir / "pinyin_table.pk", "wb") as f:
+        pk.dump(pinyin_table, f)
+
+    with open(args.input, "r") as f:
+        sentences = [line.strip().split(" ") for line in f if line.strip()]
+    if args.lines:
+        sentences = sentences[:args.lines]
+    report["load"], report["decode"] = {}, {}
+    spawn = multiprocessing.get_context("spawn")
+    for name in args.models:
+        print(f"Benchmarking {name} ...")
+        prepare_compiled(name, work_dir, args.alpha, args.beta, args.total)
+        with spawn.Pool(1) as pool:
+            report["load"][name] = pool.apply(measure_load, (name, work_dir, max(args.ks), args.alpha, args.beta, args.total))
+        report["decode"][name] = bench_decode(name, work_dir, sentences, args.ks, args.alpha, args.beta, args.total)
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"Report written to {args.output}")
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            compare(report, json.load(f))
+    if temp_dir is not None:
+        temp_dir.cleanup()
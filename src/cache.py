@@ -0,0 +1,48 @@
+from __future__ import annotations
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+class LRUCache:
+    '''
+    按容量淘汰最久未使用项的缓存：每项带一个 size（如转移矩阵的元素个数、网格层中的路径数），
+    总 size 超过 capacity 时从最久未使用的一端淘汰；hits / misses / evictions 记录命中情况
+    '''
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.size = 0
+        self.items: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        item = self.items.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        self.items.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    def put(self, key: Hashable, value: Any, size: int = 1) -> None:
+        if size > self.capacity:
+            return
+        if key in self.items:
+            self.size -= self.items.pop(key)[1]
+        self.items[key] = (value, size)
+        self.size += size
+        while self.size > self.capacity:
+            _, (_, evicted) = self.items.popitem(last=False)
+            self.size -= evicted
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self.items.clear()
+        self.size = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {"entries": len(self.items), "size": self.size, "capacity": self.capacity, \
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
@@ -1,10 +1,15 @@
-import os, json, ast
+import os, re, sys, math, json, ast, heapq, hashlib
 from pathlib import Path
-from typing import List, Dict
-from collections import defaultdict
+from typing import List, Dict, Tuple, Iterator, Iterable, Optional, Callable
+from collections import defaultdict, Counter
+from itertools import groupby
+from operator import itemgetter
+from multiprocessing import Pool
+from array import array
 from tqdm import tqdm
 import pickle as pk
 from argparse import ArgumentParser
+from store import NgramStore, CompiledStore, write_model_file, open_model_file
 
 CHAR_FREQ_TABLE = {}
 SEP = ['，', '。', '：', '、', ' ', '\n']
@@ -13,59 +18,601 @@ THERESHOLD = 2
 def build_binary_freq_table(file: Path, keys: List[str], encoding="gbk", \
                           freq_table: Dict[str, Dict[str, int]]=defaultdict(lambda : defaultdict(lambda: 0))) \
         -> Dict[str, Dict[str, int]]:
-    with open(file, "r", encoding=encoding) as f:
-        for line in tqdm(f.readlines()):
-            data = ast.literal_eval(line)
-            for key in keys:
-                try:
-                    text = data.get(key, "")
-                    if not text:
-                        continue
-                    text = " " + text + " "
-                    for i in range(len(text)-1):
-                        if text[i] in CHAR_FREQ_TABLE:
-                            CHAR_FREQ_TABLE[text[i]] += 1
-                        # 前后都在汉字表中
-                        if text[i] in CHAR_FREQ_TABLE and text[i+1] in CHAR_FREQ_TABLE:
-                            freq_table[text[i]][text[i+1]] += 1
-                        # 前面字在分隔符中，后面字在汉字表中，说明后面字为句子开头
-                        if text[i] in SEP and text[i+1] in CHAR_FREQ_TABLE:
-                            freq_table['<start>'][text[i+1]] += 1
-                        # 前面字在汉字表中，后面字在分隔符中，说明前面字为句子结尾
-                        if text[i] in CHAR_FREQ_TABLE and text[i+1] in SEP:
-                            freq_table[text[i]]['<end>'] += 1
-                except Exception as e:
-                    print(e)
-                    pass
+    # 字频累加到 CHAR_FREQ_TABLE，二元组（含句首 <start> / 句尾 <end>）累加到 freq_table
+    chars = [c for c in CHAR_FREQ_TABLE if len(c) == 1] + ['<start>', '<end>']
+    uni, bi = defaultdict(int), defaultdict(int)
+    counter = RunCounter(chars, uni, bi)
+    for text in tqdm(iter_corpus_texts(file, keys, encoding)):
+        counter.add(text)
+    counter.flush()
+    apply_counts(chars, uni, bi, {}, CHAR_FREQ_TABLE, freq_table, {})
     return freq_table
 
 def build_triple_freq_table(file: Path, keys: List[str], encoding="gbk", \
                 freq_table: Dict[str, Dict[str, Dict[str, int]]]=defaultdict(lambda : defaultdict(lambda: defaultdict(lambda: 0)))) \
         -> Dict[str, Dict[str, int]]:
+    chars = [c for c in CHAR_FREQ_TABLE if len(c) == 1] + ['<start>', '<end>']
+    tri = defaultdict(int)
+    counter = RunCounter(chars, tri=tri)
+    for text in tqdm(iter_corpus_texts(file, keys, encoding)):
+        counter.add(text)
+    counter.flush()
+    apply_counts(chars, {}, {}, tri, CHAR_FREQ_TABLE, {}, freq_table)
+    return freq_table
+
+def count_ngrams(text: str, ids: Dict[str, int], uni: Dict[int, int], bi: Dict[int, int], tri: Dict[int, int]) -> None:
+    '''
+    单遍扫描 text，同时统计字频、二元组与三元组频数，结果与 build_binary_freq_table / build_triple_freq_table 相同。
+    n-gram 以字符ID编码为整数键：二元组 x*V+y，三元组 (x*V+y)*V+z，其中 V = len(ids)。
+    '''
+    V, start, end = len(ids), ids['<start>'], ids['<end>']
+    text = " " + text + "  "
+    cid = [ids.get(c, -1) if len(c) == 1 else -1 for c in text]
+    sep = [c in SEP for c in text]
+    for i in range(len(text) - 2):
+        x, y, z = cid[i], cid[i+1], cid[i+2]
+        if x >= 0:
+            uni[x] += 1
+            if y >= 0:
+                bi[x*V + y] += 1
+                if z >= 0:
+                    tri[(x*V + y)*V + z] += 1
+                elif sep[i+2]:
+                    tri[(x*V + y)*V + end] += 1
+            elif sep[i+1]:
+                bi[x*V + end] += 1
+        elif sep[i] and y >= 0:
+            bi[start*V + y] += 1
+            if z >= 0:
+                tri[(start*V + y)*V + z] += 1
+            elif sep[i+2]:
+                tri[(start*V + y)*V + end] += 1
+
+class RunCounter:
+    '''
+    按字表内汉字串统计一至三元组，键与句首 / 句尾规则与 count_ngrams 相同：
+        正则的字符类由字表编译而成（sre 内部为按码位查找的位图），一次 findall 就在 C 层面完成整段文本的字符分类，
+        取出每个极大的字表内汉字串及其前后各一个字符；相同的 (前一字符, 串, 后一字符) 先合并计数，
+        缓冲的串展开后最多新增 max_ngrams 个二元 / 三元组键时（或调用 flush）才逐串展开成 n-gram，累加到 uni / bi / tri（为 None 的不统计）。
+    每个字最多带来一个新的二元组键和一个新的三元组键，因此按已缓冲的字数计算上界，与串是否重复无关，
+    流式构建可以据此把缓冲与溢写计数器一起限制在内存预算内。
+    语料中重复出现的短句、套话只展开一次；flush 之后的计数与逐段调用 count_ngrams 完全相同。
+    '''
+    def __init__(self, chars: List[str], uni: Optional[Dict[int, int]] = None, bi: Optional[Dict[int, int]] = None, \
+                 tri: Optional[Dict[int, int]] = None, max_ngrams: int = 10000000) -> None:
+        self.ids = {c: i for i, c in enumerate(chars)}
+        self.V = len(chars)
+        singles = "".join(re.escape(c) for c in chars if len(c) == 1)
+        self.pattern = re.compile(f"(.)([{singles}]+)(?=(.))", re.S)
+        # 既在字表中又在 SEP 中的字符按字表内汉字处理（与 count_ngrams 相同），它不会出现在串的前后
+        self.seps = frozenset(SEP)
+        self.uni, self.bi, self.tri = uni, bi, tri
+        self.max_ngrams = max_ngrams
+        self.pending = 0
+        # Counter.update 对可迭代对象的计数在 C 层完成
+        self.runs: Dict[Tuple[str, str, str], int] = Counter()
+
+    def add(self, text: str) -> bool:
+        # 返回本次是否 flush 过，调用方可以在 flush 之后检查是否需要溢写
+        self.runs.update(self.pattern.findall(" " + text + "  "))
+        self.pending += len(text) + 2
+        if self.pending > self.max_ngrams:
+            self.flush()
+            return True
+        return False
+
+    def flush(self) -> None:
+        V, start, end = self.V, self.ids['<start>'], self.ids['<end>']
+        uni, bi, tri = self.uni, self.bi, self.tri
+        for (prev, run, following), count in self.runs.items():
+            r = list(map(self.ids.__getitem__, run))
+            is_start, is_end = prev in self.seps, following in self.seps
+            if uni is not None:
+                for x in r:
+                    uni[x] += count
+            if bi is not None:
+                for x, y in zip(r, r[1:]):
+                    bi[x*V + y] += count
+                if is_start:
+                    bi[start*V + r[0]] += count
+                if is_end:
+                    bi[r[-1]*V + end] += count
+            if tri is not None:
+                for x, y, z in zip(r, r[1:], r[2:]):
+                    tri[(x*V + y)*V + z] += count
+                if len(r) > 1:
+                    if is_start:
+                        tri[(start*V + r[0])*V + r[1]] += count
+                    if is_end:
+                        tri[(r[-2]*V + r[-1])*V + end] += count
+                elif is_start and is_end:
+                    tri[(start*V + r[0])*V + end] += count
+        self.runs.clear()
+        self.pending = 0
+
+def split_corpus(files: List[Path], chunk_size: int) -> List[Tuple[Path, int, int]]:
+    # 按字节区间切分语料，每个区间处理起点落在 (start, end] 内的行（首个区间包含第0字节）
+    tasks = []
+    for file in files:
+        size = os.path.getsize(file)
+        for start in range(0, size, chunk_size):
+            tasks.append((file, start, min(start + chunk_size, size)))
+    return tasks
+
+def write_shard(path: Path, chars: List[str], uni: Dict[int, int], bi: Dict[int, int], tri: Dict[int, int]) -> None:
+    sections = {"chars": "\0".join(chars).encode("utf8")}
+    for name, counts in (("uni", uni), ("bi", bi), ("tri", tri)):
+        keys = sorted(counts)
+        sections[name + "_keys"] = array('q', keys)
+        sections[name + "_counts"] = array('q', (counts[key] for key in keys))
+    write_model_file(path, sections)
+
+def build_shard(task: Tuple[Path, int, int, List[str], str, List[str], Path]) -> Path:
+    '''
+    进程池中的 worker：流式读取语料文件的一个字节区间，单遍统计后写出一个部分计数分片
+    '''
+    file, start, end, keys, encoding, chars, shard_path = task
+    extract = key_extractor(keys)
+    uni, bi, tri = defaultdict(int), defaultdict(int), defaultdict(int)
+    counter = RunCounter(chars, uni, bi, tri)
+
+    def lines() -> Iterator[str]:
+        with open(file, "rb") as f:
+            f.seek(start)
+            if start:
+                f.readline()
+            while f.tell() <= end:
+                line = f.readline()
+                if not line:
+                    break
+                yield line.decode(encoding)
+
+    for data in parse_corpus_lines(lines()):
+        for text in extract(data):
+            counter.add(text)
+    counter.flush()
+    write_shard(shard_path, chars, uni, bi, tri)
+    return shard_path
+
+def merge_shards(shard_paths: List[Path], chars: List[str]) -> Tuple[Dict[int, int], Dict[int, int], Dict[int, int]]:
+    merged = (defaultdict(int), defaultdict(int), defaultdict(int))
+    for shard_path in shard_paths:
+        sections = open_model_file(shard_path)
+        if bytes(sections["chars"]).decode("utf8").split("\0") != chars:
+            raise ValueError(f"{shard_path} was counted with a different char table")
+        for name, counts in zip(("uni", "bi", "tri"), merged):
+            for key, count in zip(sections[name + "_keys"], sections[name + "_counts"]):
+                counts[key] += count
+    return merged
+
+def apply_counts(chars: List[str], uni: Dict[int, int], bi: Dict[int, int], tri: Dict[int, int], char_table: Dict[str, int], \
+                 binary_table: Dict[str, Dict[str, int]], triple_table: Dict[str, Dict[str, Dict[str, int]]]) -> None:
+    # 将整数键的计数累加回嵌套 dict 形式的频数表；同一上文的内层 dict 只查找一次
+    V = len(chars)
+    for x, count in uni.items():
+        char_table[chars[x]] += count
+    bi_rows: Dict[int, Dict[str, int]] = {}
+    for key, count in bi.items():
+        x, y = divmod(key, V)
+        row = bi_rows.get(x)
+        if row is None:
+            row = bi_rows[x] = binary_table[chars[x]]
+        row[chars[y]] += count
+    tri_rows: Dict[int, Dict[str, int]] = {}
+    for key, count in tri.items():
+        context, z = divmod(key, V)
+        row = tri_rows.get(context)
+        if row is None:
+            x, y = divmod(context, V)
+            row = tri_rows[context] = triple_table[chars[x]][chars[y]]
+        row[chars[z]] += count
+
+def build_freq_tables_parallel(files: List[Path], keys: List[str], encoding: str, workers: int, shard_dir: Path, \
+                               chunk_size: int = 64 << 20) -> Tuple[List[str], Dict[int, int], Dict[int, int], Dict[int, int]]:
+    '''
+    多进程构建：语料按字节区间切分，每个 worker 单遍统计一至三元组并写出分片，最后归并所有分片。
+    分片只是中间结果，归并后（或出错时）连同空的 shard_dir 一并删除
+    '''
+    chars = [c for c in CHAR_FREQ_TABLE if len(c) == 1] + ['<start>', '<end>']
+    os.makedirs(shard_dir, exist_ok=True)
+    tasks = [(file, start, end, keys, encoding, chars, shard_dir / f"shard_{i:05d}.bin") \
+                for i, (file, start, end) in enumerate(split_corpus(files, chunk_size))]
+    try:
+        with Pool(workers) as pool:
+            shard_paths = list(tqdm(pool.imap_unordered(build_shard, tasks), total=len(tasks)))
+        return (chars,) + merge_shards(sorted(shard_paths), chars)
+    finally:
+        for task in tasks:
+            if os.path.exists(task[-1]):
+                os.remove(task[-1])
+        if not os.listdir(shard_dir):
+            os.rmdir(shard_dir)
+
+def key_extractor(keys: List[str]) -> Callable[[dict], Iterator[str]]:
+    '''
+    按 keys 从一条语料记录中取出要统计的文本；键可写成 "a.b" 取嵌套对象中的字段，缺失、为空或不是字符串的字段跳过
+    '''
+    paths = [key.split(".") for key in keys]
+
+    def extract(data: dict) -> Iterator[str]:
+        for path in paths:
+            value = data
+            for part in path:
+                value = value.get(part) if isinstance(value, dict) else None
+            if value and isinstance(value, str):
+                yield value
+    return extract
+
+def parse_corpus_lines(lines: Iterable[str]) -> Iterator[dict]:
+    '''
+    逐行解析 JSON lines 语料，跳过空行。先用 json.loads，失败时改用 ast.literal_eval（Python 字面量格式的行），
+    并把成功的解析器留在前面：同一份语料的行格式通常相同，每行只需解析一次
+    '''
+    parsers = [json.loads, ast.literal_eval]
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            data = parsers[0](line)
+        except (ValueError, SyntaxError):
+            parsers.reverse()
+            data = parsers[0](line)
+        yield data
+
+def iter_corpus_texts(file: Path, keys: List[str], encoding: str = "gbk", \
+                      extract: Optional[Callable[[dict], Iterable[str]]] = None) -> Iterator[str]:
+    # 逐行读取 JSON lines 语料，不一次性读入整个文件；extract 缺省时按 keys 取字段
+    extract = extract or key_extractor(keys)
     with open(file, "r", encoding=encoding) as f:
-        for line in tqdm(f.readlines()):
-            data = ast.literal_eval(line)
-            for key in keys:
-                try:
-                    text = data.get(key, "")
-                    if not text:
+        for data in parse_corpus_lines(f):
+            yield from extract(data)
+
+class SpillingCounter(defaultdict):
+    '''
+    整数键计数器：内存中的不同键数超过 max_entries 时，把排好序的计数作为一个 run 写到磁盘并清空
+    '''
+    def __init__(self, spill_dir: Path, name: str, max_entries: int) -> None:
+        super().__init__(int)
+        self.spill_dir = spill_dir
+        self.name = name
+        self.max_entries = max_entries
+        self.runs: List[Path] = []
+
+    def maybe_spill(self) -> None:
+        if len(self) > self.max_entries:
+            self.spill()
+
+    def spill(self) -> None:
+        if not self:
+            return
+        path = self.spill_dir / f"{self.name}_run_{len(self.runs):05d}.bin"
+        keys = sorted(self)
+        write_model_file(path, {"keys": array('q', keys), "counts": array('q', (self[key] for key in keys))})
+        self.runs.append(path)
+        self.clear()
+
+def run_stream(path: Path) -> Iterator[Tuple[int, int]]:
+    sections = open_model_file(path)
+    return zip(sections["keys"], sections["counts"])
+
+def store_streams(store: NgramStore) -> Tuple[Iterator[Tuple[int, int]], Iterator[Tuple[int, int]]]:
+    # 把已有 NgramStore 的二元/三元组按整数键升序展开，可与新统计的 run 一起归并
+    V = len(store)
+    def bigrams() -> Iterator[Tuple[int, int]]:
+        for a in range(V):
+            for e in range(store.bi_offsets[a], store.bi_offsets[a + 1]):
+                if store.bi_counts[e]:
+                    yield a*V + store.bi_keys[e], store.bi_counts[e]
+    def trigrams() -> Iterator[Tuple[int, int]]:
+        for a in range(V):
+            for e in range(store.bi_offsets[a], store.bi_offsets[a + 1]):
+                context = (a*V + store.bi_keys[e]) * V
+                for t in range(store.tri_offsets[e], store.tri_offsets[e + 1]):
+                    yield context + store.tri_keys[t], store.tri_counts[t]
+    return bigrams(), trigrams()
+
+def merge_runs(streams: List[Iterable[Tuple[int, int]]]) -> Iterator[Tuple[int, int]]:
+    # 多路归并若干个按键有序的计数流，相同键的计数相加，按键升序产出 (key, count)
+    for key, group in groupby(heapq.merge(*streams), key=itemgetter(0)):
+        yield key, sum(count for _, count in group)
+
+class StoreBuilder:
+    '''
+    按 (二元组键, 三元组行) 的升序增量构建 NgramStore 的 CSR 数组，频数不超过 threshold 的项在此剪掉
+    '''
+    def __init__(self, chars: List[str], unigram: array, threshold: int = 0) -> None:
+        self.chars = chars
+        self.unigram = unigram
+        self.threshold = threshold
+        self.row_sizes = array('q', bytes(8 * len(chars)))
+        self.bi_keys, self.bi_counts = array('i'), array('q')
+        self.tri_offsets, self.tri_keys, self.tri_counts = array('q', [0]), array('i'), array('q')
+
+    def add(self, first: int, second: int, count: int, tri_row: List[Tuple[int, int]]) -> None:
+        tri_row = [(third, c) for third, c in tri_row if c > self.threshold]
+        # 仍有三元组以其为上文的二元组要保留频数，作为三元条件概率的分母
+        if count <= self.threshold and not tri_row:
+            return
+        self.row_sizes[first] += 1
+        self.bi_keys.append(second)
+        self.bi_counts.append(count)
+        for third, c in tri_row:
+            self.tri_keys.append(third)
+            self.tri_counts.append(c)
+        self.tri_offsets.append(len(self.tri_keys))
+
+    def build(self) -> NgramStore:
+        bi_offsets = array('q', [0])
+        for size in self.row_sizes:
+            bi_offsets.append(bi_offsets[-1] + size)
+        return NgramStore(self.chars, self.unigram, bi_offsets, self.bi_keys, self.bi_counts, \
+                          self.tri_offsets, self.tri_keys, self.tri_counts)
+
+def count_corpus_streaming(files: List[Path], keys: List[str], encoding: str, chars: List[str], spill_dir: Path, \
+                           max_entries: int) -> Tuple[array, List[Path], List[Path]]:
+    '''
+    流式统计：逐行读取语料，二元/三元计数在内存中超过 max_entries 个键时溢写为有序 run。
+    RunCounter 的缓冲最多展开出 max_entries / 2 个新键，每次展开后再检查是否溢写，
+    因此每一阶内存中的键数不超过 1.5 * max_entries
+    '''
+    os.makedirs(spill_dir, exist_ok=True)
+    uni = defaultdict(int)
+    bi, tri = SpillingCounter(spill_dir, "bi", max_entries), SpillingCounter(spill_dir, "tri", max_entries)
+    counter = RunCounter(chars, uni, bi, tri, max(1, max_entries // 2))
+    for file in files:
+        print(file.name)
+        for text in tqdm(iter_corpus_texts(file, keys, encoding)):
+            if counter.add(text):
+                bi.maybe_spill()
+                tri.maybe_spill()
+    counter.flush()
+    bi.spill()
+    tri.spill()
+    unigram = array('q', (uni.get(i, 0) for i in range(len(chars))))
+    return unigram, bi.runs, tri.runs
+
+def build_stores_from_runs(chars: List[str], unigram: array, bi_runs: List[Iterable[Tuple[int, int]]], \
+                           tri_runs: List[Iterable[Tuple[int, int]]], thresholds: Iterable[int] = (0,)) -> List[NgramStore]:
+    '''
+    外部归并二元与三元计数流（磁盘上的 run 或已有的 NgramStore），一遍扫描同时构建各个剪枝阈值下的 NgramStore。
+    三元组键 (x*V+y)*V+z 整除 V 即为其上文二元组的键，因此两路流可以按二元组键对齐。
+    '''
+    V, start = len(chars), chars.index('<start>')
+    builders = [StoreBuilder(chars, unigram, threshold) for threshold in thresholds]
+    bigrams = ((key, 0, count) for key, count in merge_runs(bi_runs))
+    trigrams = ((key // V, 1, key % V, count) for key, count in merge_runs(tri_runs))
+    start_total = 0
+    for bi_key, group in groupby(heapq.merge(bigrams, trigrams), key=itemgetter(0)):
+        count, tri_row = 0, []
+        for item in group:
+            if item[1] == 0:
+                count = item[2]
+            else:
+                tri_row.append((item[2], item[3]))
+        first, second = divmod(bi_key, V)
+        if first == start:
+            start_total += count
+        for builder in builders:
+            builder.add(first, second, count, tri_row)
+    # 与非流式流程一致：<start> 的字频为所有句首二元组频数之和
+    unigram[start] = start_total
+    return [builder.build() for builder in builders]
+
+def prune_store(store: NgramStore, bi_cutoff: int = 0, tri_cutoff: int = 0, top_n: int = 0, entropy: float = 0.0, \
+                alpha: float = 0.99999, beta: float = 0.9, total: int = 1000000) -> NgramStore:
+    '''
+    剪枝 NgramStore，以下条件全部满足的 n-gram 才保留：
+        bi_cutoff / tri_cutoff : 二元 / 三元组频数大于该值（与 THERESHOLD 含义相同）
+        top_n                  : 在同一上文的所有后继中频数排在前 top_n 位（0 表示不限）
+        entropy                : 相对熵（Stolcke）剪枝，删去该项带来的加权 KL 增量 P(h) * P(w|h) * log(P(w|h) / P'(w|h))
+                                 不小于 entropy，其中 P 为模型的插值概率，P' 为删去后回退到低阶插值项的概率
+    '''
+    V, end = len(store), store.char_id('<end>')
+    history_total = sum(store.unigram)
+    p_uni = [store.unigram[c] / total if c != end else 0 for c in range(V)]
+
+    def loss(p_history: float, p: float, p_backoff: float) -> float:
+        if p_backoff <= 0:
+            return math.inf
+        return p_history * p * math.log(p / p_backoff)
+
+    def top(lo: int, hi: int, counts: array) -> range:
+        if not top_n or hi - lo <= top_n:
+            return range(lo, hi)
+        return sorted(range(lo, hi), key=lambda i: -counts[i])[:top_n]
+
+    def p_bin(b: int, c: int) -> float:
+        e = store.bigram_index(b, c)
+        count = store.bi_counts[e] if e >= 0 else 0
+        return alpha * (count / store.unigram[b] if count else 0) + (1 - alpha) * p_uni[c]
+
+    builder = StoreBuilder(list(store.chars), array('q', store.unigram))
+    for a in range(V):
+        lo, hi = store.bi_offsets[a], store.bi_offsets[a + 1]
+        bi_top = set(top(lo, hi, store.bi_counts))
+        for e in range(lo, hi):
+            b, count = store.bi_keys[e], store.bi_counts[e]
+            keep = count > bi_cutoff and e in bi_top
+            if keep and entropy:
+                p_cur_on_last = count / store.unigram[a] if count else 0
+                p = alpha * p_cur_on_last + (1 - alpha) * p_uni[b]
+                keep = loss(store.unigram[a] / history_total, p, (1 - alpha) * p_uni[b]) >= entropy
+            tri_row = []
+            t_lo, t_hi = store.tri_offsets[e], store.tri_offsets[e + 1]
+            tri_top = set(top(t_lo, t_hi, store.tri_counts))
+            for t in range(t_lo, t_hi):
+                c, tri_count = store.tri_keys[t], store.tri_counts[t]
+                if tri_count <= tri_cutoff or t not in tri_top:
+                    continue
+                if entropy:
+                    backoff = p_bin(b, c)
+                    p = beta * (tri_count / count if count else 0) + (1 - beta) * backoff
+                    if loss(count / history_total, p, (1 - beta) * backoff) < entropy:
                         continue
-                    text = " " + text + "  "
-                    for i in range(len(text)-2):
-                        # if text[i] in CHAR_FREQ_TABLE:
-                        #     CHAR_FREQ_TABLE[text[i]] += 1
-                        if text[i] in CHAR_FREQ_TABLE and text[i+1] in CHAR_FREQ_TABLE and text[i+2] in CHAR_FREQ_TABLE:
-                            freq_table[text[i]][text[i+1]][text[i+2]] += 1
-                        if text[i] in SEP and text[i+1] in CHAR_FREQ_TABLE and text[i+2] in CHAR_FREQ_TABLE:
-                            freq_table['<start>'][text[i+1]][text[i+2]] += 1
-                        if text[i] in CHAR_FREQ_TABLE and text[i+1] in CHAR_FREQ_TABLE and text[i+2] in SEP:
-                            freq_table[text[i]][text[i+1]]['<end>'] += 1
-                        if text[i] in SEP and text[i+1] in CHAR_FREQ_TABLE and text[i+2] in SEP:
-                            freq_table['<start>'][text[i+1]]['<end>'] += 1
-                except Exception as e:
-                    print(e)
-                    pass
-    return freq_table
+                tri_row.append((c, tri_count))
+            if keep or tri_row:
+                builder.add(a, b, count, tri_row)
+    return builder.build()
+
+def file_digest(file: Path) -> str:
+    sha = hashlib.sha256()
+    with open(file, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+def load_manifest(data_path: Path) -> Dict[str, str]:
+    # manifest.json 记录已计入频数表的语料文件：内容 sha256 -> 文件名
+    try:
+        with open(data_path / "manifest.json", "r", encoding="utf8") as f:
+            return json.load(f)["files"]
+    except FileNotFoundError:
+        return {}
+
+def save_manifest(data_path: Path, files: Dict[str, str]) -> None:
+    with open(data_path / "manifest.json", "w", encoding="utf8") as f:
+        json.dump({"files": files}, f, ensure_ascii=False, indent=2)
+
+def update_store(data_path: Path, files: List[Path], keys: List[str], encoding: str, max_entries: int) -> Optional[NgramStore]:
+    '''
+    增量更新：只统计 manifest 中没有记录过的语料文件，把增量计数与已有的 ngram_store.bin 归并后原子替换，
+    已有的 compiled_store.bin 按原参数重新编译，正在运行的模型可通过 PinyinIMEModel.reload() 热加载。没有新文件时返回 None。
+    更新后 ngram_store.bin 是唯一的数据来源：*.pk 频数表一律不改写，不再与其保持一致。
+    '''
+    manifest = load_manifest(data_path)
+    new_files: Dict[str, Path] = {}
+    for file in files:
+        digest = file_digest(file)
+        if digest not in manifest and digest not in new_files:
+            new_files[digest] = file
+    if not new_files:
+        print("No new corpus files")
+        return None
+    print(f"{len(new_files)} new corpus file(s)")
+    store_path = data_path / "ngram_store.bin"
+    store = NgramStore.open(store_path) if store_path.exists() else NgramStore.from_pickles(data_path)
+    chars = list(store.chars)
+    delta, bi_runs, tri_runs = count_corpus_streaming(list(new_files.values()), keys, encoding, chars, \
+                                                      data_path / "spill", max_entries)
+    unigram = array('q', (count + delta[i] for i, count in enumerate(store.unigram)))
+    bi_store, tri_store = store_streams(store)
+    updated, = build_stores_from_runs(chars, unigram, [bi_store] + [run_stream(run) for run in bi_runs], \
+                                      [tri_store] + [run_stream(run) for run in tri_runs])
+    updated.save(store_path)
+    compiled_path = data_path / "compiled_store.bin"
+    if compiled_path.exists():
+        alpha, beta, total, bits = open_model_file(compiled_path)["params"]
+        compiled = CompiledStore.compile(updated, alpha, None if math.isnan(beta) else beta, total)
+        (compiled.quantize(int(bits)) if bits else compiled).save(compiled_path)
+    for run in bi_runs + tri_runs:
+        os.remove(run)
+    manifest.update({digest: file.name for digest, file in new_files.items()})
+    save_manifest(data_path, manifest)
+    return updated
+
+def iter_char_runs(text: str, chars: set) -> Iterator[Tuple[str, bool, bool]]:
+    '''
+    切出 text 中连续的字表内汉字串，返回 (串, 是否句首, 是否句尾)；
+    与 count_ngrams 相同，串前 / 串后紧邻 SEP 中的字符或文本边界时记为句首 / 句尾
+    '''
+    text = " " + text + " "
+    i, n = 1, len(text) - 1
+    while i < n:
+        if text[i] not in chars:
+            i += 1
+            continue
+        j = i + 1
+        while j < n and text[j] in chars:
+            j += 1
+        yield text[i:j], text[i - 1] in SEP, text[j] in SEP
+        i = j
+
+def count_substrings(files: List[Path], keys: List[str], encoding: str, chars: set, max_len: int, max_entries: int) \
+        -> Dict[str, int]:
+    '''
+    统计语料中长度 1..max_len 的汉字串频数（不跨过字表以外的字符）。
+    键数超过 max_entries 时丢弃低频的多字串，下限随之逐步提高；被丢弃的串其子串频数不低于它，因此不会留下缺少子串的候选词
+    '''
+    counts: Dict[str, int] = defaultdict(int)
+    floor = 2
+    for file in files:
+        print(file.name)
+        for text in tqdm(iter_corpus_texts(file, keys, encoding)):
+            for run, _, _ in iter_char_runs(text, chars):
+                for i in range(len(run)):
+                    for j in range(i + 1, min(len(run), i + max_len) + 1):
+                        counts[run[i:j]] += 1
+            if len(counts) > max_entries:
+                counts = defaultdict(int, {s: c for s, c in counts.items() if c >= floor or len(s) == 1})
+                if len(counts) > max_entries // 2:
+                    floor += 1
+    return counts
+
+def discover_words(counts: Dict[str, int], min_count: int, min_pmi: float) -> List[str]:
+    '''
+    从汉字串频数中挑出词：频数不低于 min_count，且任意一处切分的点互信息 log(P(s) / (P(a)P(b))) 都不低于 min_pmi
+    '''
+    total = sum(c for s, c in counts.items() if len(s) == 1)
+    words = []
+    for s, c in counts.items():
+        if len(s) < 2 or c < min_count:
+            continue
+        pmi = min(math.log(c * total / (counts.get(s[:i], c) * counts.get(s[i:], c))) for i in range(1, len(s)))
+        if pmi >= min_pmi:
+            words.append(s)
+    return sorted(words)
+
+def segment_run(run: str, word_cost: Dict[str, float], max_len: int) -> List[str]:
+    # 最大概率分词：单字总能成词，多字串只取 word_cost 中的词
+    n = len(run)
+    best, back = [0.0] + [math.inf] * n, [0] * (n + 1)
+    for j in range(1, n + 1):
+        for i in range(max(0, j - max_len), j):
+            cost = word_cost.get(run[i:j], math.inf if j - i > 1 else 0.0)
+            if best[i] + cost < best[j]:
+                best[j], back[j] = best[i] + cost, i
+    words = []
+    while n > 0:
+        words.append(run[back[n]:n])
+        n = back[n]
+    return words[::-1]
+
+def build_word_store(files: List[Path], keys: List[str], encoding: str, chars: List[str], max_len: int = 4, \
+                     min_count: int = 10, min_pmi: float = 3.0, max_entries: int = 10000000) -> NgramStore:
+    '''
+    构建 WordModel 使用的词级 NgramStore：第一遍统计汉字串频数并发现词，第二遍用这些词对语料做最大概率分词，
+    统计词频与词二元组（句首 / 句尾的规则与字模型相同）。字表中的每个字都作为单字词保留，
+    其频数以字频为下限（没出现过的字记为 1）：总在词内出现的字分词后频数为 0，否则在 WordModel 中没有有限代价的边
+    '''
+    char_set = set(chars)
+    counts = count_substrings(files, keys, encoding, char_set, max_len, max_entries)
+    words = discover_words(counts, min_count, min_pmi)
+    char_counts = {s: c for s, c in counts.items() if len(s) == 1}
+    total = sum(char_counts.values())
+    word_cost = {word: -math.log(counts[word] / total) for word in words}
+    word_cost |= {s: -math.log(c / total) for s, c in char_counts.items()}
+    del counts
+    word_table = dict.fromkeys(chars, 0) | dict.fromkeys(words, 0)
+    binary_table: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+    for file in files:
+        print(file.name)
+        for text in tqdm(iter_corpus_texts(file, keys, encoding)):
+            for run, is_start, is_end in iter_char_runs(text, char_set):
+                seg = segment_run(run, word_cost, max_len)
+                for word in seg:
+                    word_table[word] += 1
+                if is_start:
+                    binary_table['<start>'][seg[0]] += 1
+                for first, second in zip(seg, seg[1:]):
+                    binary_table[first][second] += 1
+                if is_end:
+                    binary_table[seg[-1]]['<end>'] += 1
+    # 分词后从未用到的候选词不进入词表
+    word_table = {word: count for word, count in word_table.items() if count or len(word) == 1}
+    for c in chars:
+        word_table[c] = max(word_table[c], char_counts.get(c, 0), 1)
+    word_table['<start>'] = sum(binary_table['<start>'].values())
+    return NgramStore.from_tables(word_table, {first: dict(row) for first, row in binary_table.items()})
 
 def build_pinyin_table(file: Path) -> Dict[str, List[str]]:
     with open(file, "r", encoding="gbk") as f:
@@ -86,7 +633,7 @@ if __name__ == '__main__':
         type=str,
         nargs="+",
         dest="keys",
-        help="Corpus keys",
+        help="Corpus keys; a dotted key (a.b) reads a field of a nested object",
         default=["title", "html"],
     )
     parser.add_argument(
@@ -103,6 +650,66 @@ if __name__ == '__main__':
         help="Origin freq table path",
         default=""
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        dest="workers",
+        help="Number of worker processes; >1 counts byte-range shards in parallel and merges them",
+        default=1
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        dest="chunk_size",
+        help="Corpus bytes per shard in parallel mode",
+        default=64 << 20
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        dest="stream",
+        help="Bounded-memory build: spill sorted count runs to disk and k-way merge them into ngram_store(_compress).bin"
+    )
+    parser.add_argument(
+        "--max-entries",
+        type=int,
+        dest="max_entries",
+        help="Distinct n-gram keys kept in memory per order before spilling a run in stream mode",
+        default=10000000
+    )
+    parser.add_argument(
+        "--update",
+        action="store_true",
+        dest="update",
+        help="Incrementally add corpus files not yet listed in manifest.json to the existing ngram_store.bin"
+    )
+    parser.add_argument(
+        "--words",
+        action="store_true",
+        dest="words",
+        help="Also build word_store.bin (word lexicon and word bigram counts) for the word-level model"
+    )
+    parser.add_argument(
+        "--word-max-len",
+        type=int,
+        dest="word_max_len",
+        help="Longest word, in characters, considered by --words",
+        default=4
+    )
+    parser.add_argument(
+        "--word-min-count",
+        type=int,
+        dest="word_min_count",
+        help="Minimum corpus count of a word found by --words",
+        default=10
+    )
+    parser.add_argument(
+        "--word-min-pmi",
+        type=float,
+        dest="word_min_pmi",
+        help="Minimum pointwise mutual information across every split of a word found by --words",
+        default=3.0
+    )
     args = parser.parse_args()
 
     ROOT = Path(__file__).parent.parent
@@ -118,6 +725,7 @@ if __name__ == '__main__':
     TRI_FREQ_TABLE_COMPRESS_PATH = DATA_PATH / "triple_freq_table_compress.pk"
     CHAR_TABLE_PATH = DATA_PATH / "char_freq_table.pk"
     PINYIN_TABLE_PATH = DATA_PATH / "pinyin_table.pk"
+    NGRAM_STORE_PATH = DATA_PATH / "ngram_store.bin"
 
     BIN_FREQ_TABLE_PATH_2 = DATA_PATH_2 / "binary_freq_table.pk"
     TRI_FREQ_TABLE_PATH_2 = DATA_PATH_2 / "triple_freq_table.pk"
@@ -126,6 +734,40 @@ if __name__ == '__main__':
     CHAR_TABLE_PATH_2 = DATA_PATH_2 / "char_freq_table.pk"
     PINYIN_TABLE_PATH_2 = DATA_PATH_2 / "pinyin_table.pk"
 
+    CORPUS_FILES = [CORPUS_PATH / file for file in sorted(os.listdir(CORPUS_PATH)) if "README" not in file and ".DS_Store" not in file]
+    PINYIN_TABLE = build_pinyin_table(ROOT / "table" / "拼音汉字表.txt")
+    PINYIN_TABLE['<end>'] = ['<end>']
+
+    if args.words:
+        with open(ROOT / "table" / "一二级汉字表.txt", "r", encoding="gbk") as f:
+            chars = list(dict.fromkeys(f.read().strip()))
+        build_word_store(CORPUS_FILES, args.keys, args.encoding, chars, args.word_max_len, args.word_min_count, \
+                         args.word_min_pmi, args.max_entries).save(DATA_PATH / "word_store.bin")
+
+    if args.update:
+        update_store(DATA_PATH, CORPUS_FILES, args.keys, args.encoding, args.max_entries)
+        sys.exit(0)
+
+    if args.stream:
+        # 流式构建只输出 ngram_store.bin / ngram_store_compress.bin，不在内存中展开完整的嵌套 dict
+        with open(ROOT / "table" / "一二级汉字表.txt", "r", encoding="gbk") as f:
+            chars = list(dict.fromkeys(f.read())) + ['<start>', '<end>']
+        unigram, bi_runs, tri_runs = count_corpus_streaming(CORPUS_FILES, args.keys, args.encoding, chars, \
+                                                            DATA_PATH / "spill", args.max_entries)
+        store, store_compress = build_stores_from_runs(chars, unigram, [run_stream(run) for run in bi_runs], \
+                                                       [run_stream(run) for run in tri_runs], (0, THERESHOLD))
+        store.save(NGRAM_STORE_PATH)
+        store_compress.save(DATA_PATH / "ngram_store_compress.bin")
+        for run in bi_runs + tri_runs:
+            os.remove(run)
+        CHAR_FREQ_TABLE = {c: unigram[i] for i, c in enumerate(chars) if c != '<end>'}
+        with open(CHAR_TABLE_PATH, "wb") as f:
+            pk.dump(CHAR_FREQ_TABLE, f)
+        with open(PINYIN_TABLE_PATH, "wb") as f:
+            pk.dump(PINYIN_TABLE, f)
+        save_manifest(DATA_PATH, {file_digest(file): file.name for file in CORPUS_FILES})
+        sys.exit(0)
+
     if args.table:
         TABLE_PATH = Path(args.table)
         with open(TABLE_PATH / "char_freq_table.pk", "rb") as f:
@@ -146,11 +788,15 @@ if __name__ == '__main__':
         BIN_FREQ_TABLE = defaultdict(lambda : defaultdict(lambda: 0))
         TRI_FREQ_TABLE = defaultdict(lambda : defaultdict(lambda: defaultdict(lambda: 0)))
 
-    for file in os.listdir(CORPUS_PATH):
-        if "README" not in file and ".DS_Store" not in file:
-            print(file)
-            BIN_FREQ_TABLE = build_binary_freq_table(CORPUS_PATH / file, args.keys, args.encoding, BIN_FREQ_TABLE)
-            TRI_FREQ_TABLE = build_triple_freq_table(CORPUS_PATH / file, args.keys, args.encoding, TRI_FREQ_TABLE)
+    if args.workers > 1:
+        chars, uni, bi, tri = build_freq_tables_parallel(CORPUS_FILES, args.keys, args.encoding, args.workers, \
+                                                         DATA_PATH / "shards", args.chunk_size)
+        apply_counts(chars, uni, bi, tri, CHAR_FREQ_TABLE, BIN_FREQ_TABLE, TRI_FREQ_TABLE)
+    else:
+        for file in CORPUS_FILES:
+            print(file.name)
+            BIN_FREQ_TABLE = build_binary_freq_table(file, args.keys, args.encoding, BIN_FREQ_TABLE)
+            TRI_FREQ_TABLE = build_triple_freq_table(file, args.keys, args.encoding, TRI_FREQ_TABLE)
             # print(dict(FREQ_TABLE['<start>']))
 
     BIN_FREQ_TABLE = {k: dict(BIN_FREQ_TABLE[k]) for k in BIN_FREQ_TABLE}
@@ -184,9 +830,7 @@ if __name__ == '__main__':
         print("e2", e)
         pass
     
-    PINYIN_TABLE = build_pinyin_table(ROOT / "table" / "拼音汉字表.txt")
     CHAR_FREQ_TABLE['<start>'] = sum(BIN_FREQ_TABLE['<start>'].values())
-    PINYIN_TABLE['<end>'] = ['<end>']
     try:
         with open(CHAR_TABLE_PATH_2, "wb") as f:
             pk.dump(CHAR_FREQ_TABLE, f)
@@ -202,4 +846,13 @@ if __name__ == '__main__':
             pk.dump(PINYIN_TABLE, f)
     except Exception as e:
         print("e4", e)
-        pass
\ No newline at end of file
+        pass
+    try:
+        NgramStore.from_tables(CHAR_FREQ_TABLE, BIN_FREQ_TABLE, TRI_FREQ_TABLE).save(NGRAM_STORE_PATH)
+    except Exception as e:
+        print("e5", e)
+        pass
+    # --table 模式下的旧语料由原表的 manifest 记录
+    manifest = load_manifest(Path(args.table)) if args.table else {}
+    manifest.update({file_digest(file): file.name for file in CORPUS_FILES})
+    save_manifest(DATA_PATH, manifest)
@@ -0,0 +1,244 @@
+from __future__ import annotations
+import math, heapq
+from itertools import islice
+from typing import List, Tuple, Iterator
+from models import PinyinIMEModel, CompiledBinaryModel, CompiledTripleModel
+from store import QuantizedArray, COST_TABLES
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+class _QuantizedCosts:
+    # QuantizedArray 的 numpy 视图：按（花式）下标取码字再查码本，不展开整张表
+    def __init__(self, table: QuantizedArray) -> None:
+        self.codes = np.asarray(table.codes)
+        self.codebook = np.asarray(table.codebook)
+
+    def __getitem__(self, index):
+        return self.codebook[self.codes[index]]
+
+def _cost_table(table):
+    return _QuantizedCosts(table) if isinstance(table, QuantizedArray) else np.asarray(table)
+
+def topk_columns(cand: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    对 (n, C) 的候选代价矩阵逐列取最小的 k 项，返回 (C, k) 的代价与行号（不足 k 项时以 inf / -1 补齐）。
+    先用 argpartition 找出第 k 小的值，再按 (代价, 行号) 排序，与原 inference 中稳定排序的结果一致。
+    '''
+    n, C = cand.shape
+    if n > k:
+        kth = np.take_along_axis(cand, np.argpartition(cand, k - 1, axis=0)[k - 1:k], axis=0)[0]
+        less, equal = cand < kth, cand == kth
+        # 与第 k 小的值相等的项按行号先后补足 k 个
+        keep = less | (equal & (np.cumsum(equal, axis=0) <= k - less.sum(axis=0)))
+    else:
+        keep = np.ones(cand.shape, dtype=bool)
+    keep &= np.isfinite(cand)
+    cols, rows = np.nonzero(keep.T)
+    vals = cand[rows, cols]
+    order = np.lexsort((rows, vals, cols))
+    cols, rows, vals = cols[order], rows[order], vals[order]
+    rank = np.arange(len(cols)) - np.searchsorted(cols, cols)
+    out_vals, out_rows = np.full((C, k), np.inf), np.full((C, k), -1, dtype=np.int64)
+    out_vals[cols, rank], out_rows[cols, rank] = vals, rows
+    return out_vals, out_rows
+
+class NumpyDecoder:
+    '''
+    向量化的 Viterbi / top-k 解码器：每一层的转移代价取为 |prev| x |cur| 的矩阵，
+    候选路径以 (prev x k) 为行整体做 top-k 选择，路径用回溯指针数组还原。
+    输出与 BinaryModel / TripleModel 的 inference 相同。
+    '''
+    def __init__(self, model: PinyinIMEModel) -> None:
+        if np is None:
+            raise ImportError("NumpyDecoder requires numpy")
+        self.model = model
+        self.k = model.k
+        self._bind()
+
+    def _bind(self) -> None:
+        # 模型热加载后 store / compiled 会被替换，这里重新取出数组视图
+        model, store = self.model, self.model.store
+        self.store = store
+        self.bi_offsets, self.bi_keys = np.asarray(store.bi_offsets), np.asarray(store.bi_keys)
+        self.tri_offsets, self.tri_keys = np.asarray(store.tri_offsets), np.asarray(store.tri_keys)
+        compiled = getattr(model, "compiled", None)
+        if compiled is not None:
+            for name in COST_TABLES:
+                setattr(self, name, _cost_table(getattr(compiled, name)))
+
+    def _ids(self, chars: List[str]) -> np.ndarray:
+        ids = self.model.store.ids
+        return np.array([ids.get(char, -1) for char in chars], dtype=np.int64)
+
+    def _fill_row(self, row: np.ndarray, keys: np.ndarray, costs: np.ndarray, lo: int, hi: int, cur: np.ndarray) -> None:
+        # 在 CSR 的一行 keys[lo:hi] 中批量查找 cur，命中的位置用 costs 覆盖
+        if hi <= lo:
+            return
+        segment = keys[lo:hi]
+        pos = np.minimum(np.searchsorted(segment, cur), hi - lo - 1)
+        found = segment[pos] == cur
+        row[found] = costs[lo + pos[found]]
+
+    def _binary_row(self, a: int, cur: np.ndarray) -> np.ndarray:
+        row = self.uni_cost[cur]
+        if a >= 0:
+            self._fill_row(row, self.bi_keys, self.bi_cost, self.bi_offsets[a], self.bi_offsets[a + 1], cur)
+        return row
+
+    def _triple_row(self, a: int, b: int, cur: np.ndarray) -> np.ndarray:
+        row = self.uni_tri_cost[cur]
+        if b >= 0:
+            self._fill_row(row, self.bi_keys, self.bi_tri_cost, self.bi_offsets[b], self.bi_offsets[b + 1], cur)
+        e = self.model.store.bigram_index(a, b)
+        if e >= 0:
+            self._fill_row(row, self.tri_keys, self.tri_cost, self.tri_offsets[e], self.tri_offsets[e + 1], cur)
+        return row
+
+    def transition_matrix(self, last_states: List[str], chars: List[str]) -> np.ndarray:
+        model = self.model
+        if not isinstance(model, (CompiledBinaryModel, CompiledTripleModel)):
+            return np.array(model.transition_block(last_states, chars), dtype=np.float64).reshape(len(last_states), len(chars))
+        ids = model.store.ids
+        cur = self._ids(chars)
+        known = cur >= 0
+        cur_known = np.where(known, cur, 0)
+        rows = []
+        for state in last_states:
+            if isinstance(model, CompiledTripleModel) and state != '<start>':
+                first = '<start>' if state.startswith('<start>') else state[0]
+                row = self._triple_row(ids.get(first, -1), ids.get(state[-1], -1), cur_known)
+            else:
+                row = self._binary_row(ids.get(state, -1), cur_known)
+            rows.append(np.where(known, row, np.inf))
+        return np.array(rows, dtype=np.float64).reshape(len(last_states), len(chars))
+
+    def inference(self, pinyin_sentence: List[str]) -> List[str]:
+        if not pinyin_sentence:
+            return []
+        if self.model.store is not self.store:
+            self._bind()
+        k = self.k
+        states: List[str] = ['<start>']
+        scores = np.full((1, k), np.inf)
+        scores[0, 0] = 0
+        # 每层记录 (新增字符, 回溯指针)；回溯指针为上一层 (state, rank) 展平后的下标
+        history: List[Tuple[List[str], np.ndarray]] = []
+        for pinyin in pinyin_sentence + ['<end>']:
+            chars = self.model.candidate_chars(pinyin)
+            trans = self.transition_matrix(states, chars)
+            # 按“下一状态”对上一层分组：二元模型全部归为一组，三元模型按末字分组
+            groups = {}
+            for i, state in enumerate(states):
+                key = '' if self.model.ORDER < 3 or state == '<start>' else state[-1]
+                groups.setdefault(key, []).append(i)
+            new_entries = []
+            for group_rows in groups.values():
+                group_rows = np.array(group_rows)
+                cand = (scores[group_rows][:, :, None] + trans[group_rows][:, None, :]).reshape(len(group_rows) * k, len(chars))
+                vals, rows = topk_columns(cand, k)
+                back = np.where(rows >= 0, group_rows[rows // k] * k + rows % k, -1)
+                finite = np.isfinite(trans[group_rows])
+                for c, char in enumerate(chars):
+                    if self.model.ORDER >= 3 and char == '<end>':
+                        continue
+                    if self.model.ORDER >= 3 and not finite[:, c].any():
+                        continue
+                    # 三元模型中新状态按 (当前字, 首个可达的上一状态) 的顺序插入，与原实现一致
+                    first = group_rows[np.argmax(finite[:, c])] if self.model.ORDER >= 3 else 0
+                    new_entries.append(((c, first), self.model.next_state(states[group_rows[0]], char), char, vals[c], back[c]))
+            if self.model.ORDER >= 3 and '<end>' in chars:
+                # 终止节点收束为一个 <end>
+                c = chars.index('<end>')
+                all_rows = np.arange(len(states))
+                cand = (scores[:, :, None] + trans[:, None, c:c + 1]).reshape(len(states) * k, 1)
+                vals, rows = topk_columns(cand, k)
+                new_entries.append(((c, 0), '<end>', '<end>', vals[0], np.where(rows[0] >= 0, all_rows[rows[0] // k] * k + rows[0] % k, -1)))
+            new_entries.sort(key=lambda entry: entry[0])
+            states = [entry[1] for entry in new_entries]
+            scores = np.array([entry[3] for entry in new_entries]).reshape(len(new_entries), k)
+            back = np.array([entry[4] for entry in new_entries], dtype=np.int64).reshape(len(new_entries), k)
+            history.append(([entry[2] for entry in new_entries], back))
+            if not states:
+                return []
+        results = []
+        for top in range(k):
+            if not math.isfinite(scores[0, top]):
+                break
+            path, state, rank = [], 0, top
+            for chars, back in reversed(history):
+                path.append(chars[state])
+                state, rank = divmod(int(back[state, rank]), k)
+            results.append("".join(reversed(path)).strip('<end>'))
+        return results
+
+def _extend_paths(paths: List[Tuple[float, int, int]], cost: float, state: int) -> Iterator[Tuple[float, int, int]]:
+    # 上一状态的有序路径整体加上转移代价，回溯指针指向 (上一状态, 名次)
+    for rank, (path_cost, _, _) in enumerate(paths):
+        yield path_cost + cost, state, rank
+
+class BeamDecoder:
+    '''
+    k-best 束搜索解码器：
+        每个节点的 top-k 路径由各上一状态的有序路径经 heapq.merge 多路归并取前 k 项，代价 O(P + k log P)，而非对 P*k 项整体排序；
+        beam_width > 0 时每层只保留最优路径代价最小的 beam_width 个状态；
+        threshold 为相对当前层最优路径的代价阈值，超出的路径被剪掉；
+        路径以 (代价, 上一状态, 名次) 的回溯指针保存，最后再还原成字符串。
+    beam_width=0、threshold=inf 时输出与模型自身的 inference 相同。
+    '''
+    def __init__(self, model: PinyinIMEModel, beam_width: int = 0, threshold: float = math.inf) -> None:
+        self.model = model
+        self.beam_width = beam_width
+        self.threshold = threshold
+
+    def prune(self, paths: List[List[Tuple[float, int, int]]]) -> List[int]:
+        # 返回剪枝后保留的状态下标（保持原顺序）
+        best = min((state_paths[0][0] for state_paths in paths if state_paths), default=math.inf)
+        if self.threshold != math.inf:
+            for i, state_paths in enumerate(paths):
+                paths[i] = [path for path in state_paths if path[0] <= best + self.threshold]
+        keep = [i for i, state_paths in enumerate(paths) if state_paths]
+        if self.beam_width and len(keep) > self.beam_width:
+            keep = sorted(sorted(keep, key=lambda i: paths[i][0][0])[:self.beam_width])
+        return keep
+
+    def inference(self, pinyin_sentence: List[str]) -> List[str]:
+        if not pinyin_sentence:
+            return []
+        model, k = self.model, self.model.k
+        names: List[str] = ['<start>']
+        paths: List[List[Tuple[float, int, int]]] = [[(0.0, -1, -1)]]
+        history: List[Tuple[List[str], List[List[Tuple[float, int, int]]]]] = []
+        for pinyin in pinyin_sentence + ['<end>']:
+            chars = model.candidate_chars(pinyin)
+            block = model.transition_block(names, chars)
+            index = {}
+            new_names, new_chars, sources = [], [], []
+            for j, char in enumerate(chars):
+                for i, name in enumerate(names):
+                    cost = block[i][j]
+                    if cost == math.inf:
+                        continue
+                    next_name = model.next_state(name, char)
+                    if next_name not in index:
+                        index[next_name] = len(new_names)
+                        new_names.append(next_name)
+                        new_chars.append(char)
+                        sources.append([])
+                    sources[index[next_name]].append(_extend_paths(paths[i], cost, i))
+            new_paths = [list(islice(heapq.merge(*iterators), k)) for iterators in sources]
+            keep = self.prune(new_paths)
+            names = [new_names[i] for i in keep]
+            paths = [new_paths[i] for i in keep]
+            history.append(([new_chars[i] for i in keep], paths))
+            if not names:
+                return []
+        results = []
+        for rank in range(len(paths[0])):
+            path, state, r = [], 0, rank
+            for chars, layer_paths in reversed(history):
+                path.append(chars[state])
+                _, state, r = layer_paths[state][r]
+            results.append("".join(reversed(path)).strip('<end>'))
+        return results
@@ -0,0 +1,88 @@
+from __future__ import annotations
+import time
+from contextlib import contextmanager
+from collections import defaultdict
+from typing import List, Dict, Iterator
+
+class DecodeStats:
+    '''
+    解码过程的统计：转移次数、每层节点数、被 top-k 截断的路径数、n-gram 查表次数与未命中次数、各阶段耗时。
+    model.stats 为 None（默认）时模型不做任何统计
+    '''
+    STAGES = ("transition", "merge", "sort", "total")
+
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        self.sentences = 0
+        self.layers = 0
+        self.transitions = 0
+        self.finite_transitions = 0
+        self.nodes: List[int] = []
+        self.paths_generated = 0
+        self.paths_kept = 0
+        self.lookups = 0
+        self.misses = 0
+        self.times: Dict[str, float] = defaultdict(float)
+
+    def lookup(self, hit: bool) -> None:
+        self.lookups += 1
+        if not hit:
+            self.misses += 1
+
+    def add_time(self, stage: str, seconds: float) -> None:
+        self.times[stage] += seconds
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] += time.perf_counter() - start
+
+    def layer(self, transitions: int, finite_transitions: int, paths_generated: int, nodes: int, paths_kept: int) -> None:
+        self.layers += 1
+        self.transitions += transitions
+        self.finite_transitions += finite_transitions
+        self.paths_generated += paths_generated
+        self.nodes.append(nodes)
+        self.paths_kept += paths_kept
+
+    def merge(self, other: DecodeStats) -> None:
+        for name in ("sentences", "layers", "transitions", "finite_transitions", "paths_generated", "paths_kept", "lookups", "misses"):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        self.nodes += other.nodes
+        for stage, seconds in other.times.items():
+            self.times[stage] += seconds
+
+    def summary(self) -> Dict[str, float]:
+        nodes = sorted(self.nodes)
+        return {
+            "sentences": self.sentences,
+            "layers": self.layers,
+            "transitions": self.transitions,
+            "finite_transitions": self.finite_transitions,
+            "nodes_mean": sum(nodes) / len(nodes) if nodes else 0.0,
+            "nodes_p99": nodes[min(len(nodes) - 1, int(len(nodes) * 0.99))] if nodes else 0,
+            "nodes_max": nodes[-1] if nodes else 0,
+            "paths_generated": self.paths_generated,
+            "paths_pruned": self.paths_generated - self.paths_kept,
+            "lookups": self.lookups,
+            "misses": self.misses,
+        } | {f"{stage}_s": self.times.get(stage, 0.0) for stage in self.STAGES}
+
+    def report(self) -> str:
+        summary = self.summary()
+        total = summary["total_s"] or 1.0
+        lines = [
+            f"句数：{summary['sentences']}，层数：{summary['layers']}",
+            f"转移：{summary['transitions']}（有限代价 {summary['finite_transitions']}）",
+            f"每层节点数：平均 {summary['nodes_mean']:.1f}，p99 {summary['nodes_p99']}，最大 {summary['nodes_max']}",
+            f"候选路径：{summary['paths_generated']}，被 top-k 截断 {summary['paths_pruned']}",
+            f"n-gram 查表：{summary['lookups']}，未命中（回退）{summary['misses']}",
+        ]
+        for stage in self.STAGES:
+            lines.append(f"{stage:>10}: {summary[stage + '_s']:.3f}s ({summary[stage + '_s'] / total * 100:.1f}%)")
+        return "\n".join(lines)
@@ -1,11 +1,18 @@
 from __future__ import annotations
-import os, math, json
+import os, math, json, time, heapq
 from pathlib import Path
-from typing import List, Dict
+from typing import List, Dict, Tuple, Iterable, Iterator, Optional
+from collections import defaultdict
+from itertools import product
 import pickle as pk
 import abc
+from store import NgramStore, CompiledStore, load_store, load_compiled
+from cache import LRUCache
+from instrument import DecodeStats
+from segment import SyllableIndex
 
 ROOT = Path(__file__).parent.parent
+_WORD = ""
 
 class CharNode:
     def __init__(self, char: str, topk_path: Dict[str, float] = {}) -> None:
@@ -13,14 +20,127 @@ class CharNode:
         self.topk_path = topk_path
 
 class PinyinIMEModel(metaclass=abc.ABCMeta):
+    ORDER = 1
+    STORE_FILE = "ngram_store.bin"
+
     def __init__(self, k: int = 1, total: int = 100000, data_path: Path = ROOT / "src") -> None:
         self.k = k
         self.total = total
         self.node_layer: List[CharNode] = [CharNode('<start>', {"": 0})]
-        with open(data_path / "PINYIN_TABLE.pk", "rb") as f:
+        with open(data_path / "pinyin_table.pk", "rb") as f:
             self.PINYIN_TABLE: Dict[str, List[str]] = pk.load(f)
-        with open(data_path / "CHAR_FREQ_TABLE.pk", "rb") as f:
-            self.CHAR_FREQ_TABLE: Dict[str, int] = pk.load(f)
+        self.data_path = data_path
+        self.store_stamp = self._store_stamp()
+        self.store: NgramStore = self.open_store()
+        self.block_cache: Optional[LRUCache] = None
+        self.prefix_cache: Optional[LRUCache] = None
+        self.stats: Optional[DecodeStats] = None
+        self._syllables: Optional[SyllableIndex] = None
+
+    def _store_stamp(self) -> Optional[tuple]:
+        try:
+            stat = os.stat(self.data_path / self.STORE_FILE)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def open_store(self) -> NgramStore:
+        return load_store(self.data_path, triple=self.ORDER >= 3)
+
+    def reload(self) -> bool:
+        '''
+        ngram_store.bin（STORE_FILE）被（增量更新）替换后重新映射，无需重启进程；返回是否发生了重新加载
+        '''
+        stamp = self._store_stamp()
+        if stamp is None or stamp == self.store_stamp:
+            return False
+        self.store = self.open_store()
+        self.store_stamp = stamp
+        self.clear_cache()
+        return True
+
+    def set_cache(self, block_capacity: int = 0, prefix_capacity: int = 0) -> None:
+        '''
+        开启跨查询的 LRU 缓存（容量为 0 表示不缓存）：
+            block_capacity: 转移代价矩阵缓存的总元素数，键为 (上一层状态, 当前拼音)，二元模型下即 (上一音节, 当前音节)；
+            prefix_capacity: 拼音前缀网格层缓存的总路径数，键为 (k, 拼音前缀)，之后的解码从最长的已缓存前缀接着扩展
+        '''
+        self.block_cache = LRUCache(block_capacity) if block_capacity else None
+        self.prefix_cache = LRUCache(prefix_capacity) if prefix_capacity else None
+
+    def clear_cache(self) -> None:
+        for cache in (self.block_cache, self.prefix_cache):
+            if cache is not None:
+                cache.clear()
+
+    def cache_stats(self) -> Dict[str, Dict[str, int]]:
+        return {name: cache.stats() for name, cache in (("block", self.block_cache), ("prefix", self.prefix_cache)) \
+                if cache is not None}
+
+    def cached_block(self, node_layer: List[CharNode], pinyin: str) -> Optional[List[List[float]]]:
+        if self.block_cache is None:
+            return None
+        key = (tuple(node.char for node in node_layer), pinyin)
+        block = self.block_cache.get(key)
+        if block is None:
+            chars = self.candidate_chars(pinyin)
+            block = self.transition_block(list(key[0]), chars)
+            self.block_cache.put(key, block, len(key[0]) * len(chars))
+        return block
+
+    def enable_stats(self, enabled: bool = True) -> Optional[DecodeStats]:
+        # 开启 / 关闭解码统计；关闭时热路径上只多一次 self.stats is None 判断
+        self.stats = DecodeStats() if enabled else None
+        return self.stats
+
+    def step(self, node_layer: List[CharNode], pinyin: str, k: Optional[int] = None, \
+             block: Optional[List[List[float]]] = None) -> List[CharNode]:
+        '''
+        extend_layer 加上（开启时的）统计：转移矩阵与路径合并分开计时，并记录本层的转移数、节点数与被截断的路径数
+        '''
+        stats = self.stats
+        if stats is None:
+            return self.extend_layer(node_layer, pinyin, k, block)
+        chars = self.candidate_chars(pinyin)
+        if block is None:
+            with stats.stage("transition"):
+                block = self.transition_block([node.char for node in node_layer], chars)
+        sort_time = stats.times["sort"]
+        start = time.perf_counter()
+        new_node_layer = self.extend_layer(node_layer, pinyin, k, block)
+        stats.add_time("merge", time.perf_counter() - start - (stats.times["sort"] - sort_time))
+        finite, generated = 0, 0
+        for i, last_node in enumerate(node_layer):
+            reachable = sum(cost != math.inf for cost in block[i])
+            finite += reachable
+            generated += reachable * len(last_node.topk_path)
+        stats.layer(len(node_layer) * len(chars), finite, generated, len(new_node_layer), \
+                    sum(len(node.topk_path) for node in new_node_layer))
+        return new_node_layer
+
+    def decode_cached(self, pinyin_sentence: List[str], k: Optional[int] = None) -> List[str]:
+        '''
+        利用缓存解码：先沿前缀找到最长的已缓存网格层，再逐层扩展（转移矩阵同样查缓存），新算出的层放回缓存。
+        不读写 self.node_layer，结果与 inference 相同
+        '''
+        if not pinyin_sentence:
+            return []
+        k = k or self.k
+        sentence = tuple(pinyin_sentence) + ('<end>',)
+        node_layer, step = [CharNode('<start>', {"": 0})], 0
+        if self.prefix_cache is not None:
+            while step < len(sentence):
+                cached = self.prefix_cache.get((k, sentence[:step + 1]))
+                if cached is None:
+                    break
+                node_layer, step = cached, step + 1
+        for step in range(step, len(sentence)):
+            node_layer = self.step(node_layer, sentence[step], k, self.cached_block(node_layer, sentence[step]))
+            if self.prefix_cache is not None:
+                self.prefix_cache.put((k, sentence[:step + 1]), node_layer, sum(len(node.topk_path) for node in node_layer))
+        if not node_layer:
+            return []
+        return list(map(lambda key: key.strip('<end>'), node_layer[0].topk_path.keys()))
         
     def reset(self):
         self.node_layer: List[CharNode] = [CharNode('<start>', {"": 0})]
@@ -28,23 +148,198 @@ class PinyinIMEModel(metaclass=abc.ABCMeta):
     @abc.abstractmethod
     def calc_path_cost(self, last_node: CharNode, cur_node: CharNode) -> float:
         pass   
+
+    @property
+    def syllables(self) -> SyllableIndex:
+        # 音节 trie 与前缀索引只在第一次用到时构建
+        if self._syllables is None:
+            self._syllables = SyllableIndex(self.PINYIN_TABLE)
+        return self._syllables
+
+    def candidate_chars(self, pinyin: str) -> List[str]:
+        # 完整音节直接查表；以 * 结尾的缩写（声母或未打完的音节，如 "zh*"）取该前缀下所有音节候选字的并集
+        if pinyin.endswith('*'):
+            return self.syllables.prefix_chars.get(pinyin[:-1], [])
+        return self.PINYIN_TABLE[pinyin]
+
+    def next_state(self, last_char: str, char: str) -> str:
+        # 从状态 last_char 接上字 char 之后的新状态名：二元模型即为当前字本身
+        return char
+
+    def transition_block(self, last_chars: List[str], chars: List[str]) -> List[List[float]]:
+        # |last_chars| x |chars| 的转移代价矩阵
+        nodes = [CharNode(char, {}) for char in chars]
+        return [[self.calc_path_cost(CharNode(last_char, {}), node) for node in nodes] for last_char in last_chars]
     
+    @abc.abstractmethod
+    def extend_layer(self, node_layer: List[CharNode], pinyin: str, k: Optional[int] = None, \
+                     block: Optional[List[List[float]]] = None) -> List[CharNode]:
+        '''
+        无状态地将 node_layer 扩展一层（pinyin 对应的候选字），返回新的一层；
+        block 为预先算好的 |node_layer| x |PINYIN_TABLE[pinyin]| 转移代价矩阵，缺省时逐对计算
+        '''
+        pass
+
     @abc.abstractmethod
     def inference(self, pinyin_sentence: List[str]) -> List[str]:
         pass
 
+    def session(self, k: Optional[int] = None, beam_width: int = 0) -> DecodeSession:
+        return DecodeSession(self, k, beam_width)
+
+    def decode_batch(self, pinyin_sentences: List[List[str]], k: Optional[int] = None) -> List[List[str]]:
+        # 与 inference 相同的统计：句数与 total 阶段计时
+        if self.stats is not None:
+            self.stats.sentences += sum(1 for sentence in pinyin_sentences if sentence)
+            with self.stats.stage("total"):
+                return self._decode_batch(pinyin_sentences, k)
+        return self._decode_batch(pinyin_sentences, k)
+
+    def _decode_batch(self, pinyin_sentences: List[List[str]], k: Optional[int] = None) -> List[List[str]]:
+        '''
+        无状态的批量解码，不读写 self.node_layer。
+        句子按长度分组、按位置同步推进：相同拼音前缀的句子共用同一层网格，
+        同一步中上一层状态与当前拼音都相同的转移代价矩阵只计算一次。
+        '''
+        results: List[List[str]] = [[] for _ in pinyin_sentences]
+        by_length: Dict[int, List[int]] = defaultdict(list)
+        for i, sentence in enumerate(pinyin_sentences):
+            if sentence:
+                by_length[len(sentence)].append(i)
+        for length, indices in by_length.items():
+            sentences = {i: tuple(pinyin_sentences[i]) + ('<end>',) for i in indices}
+            layers: Dict[tuple, List[CharNode]] = {(): [CharNode('<start>', {"": 0})]}
+            for step in range(length + 1):
+                new_layers: Dict[tuple, List[CharNode]] = {}
+                blocks: Dict[tuple, List[List[float]]] = {}
+                for i in indices:
+                    prefix = sentences[i][:step + 1]
+                    if prefix in new_layers:
+                        continue
+                    node_layer, pinyin = layers[prefix[:-1]], prefix[-1]
+                    key = (tuple(node.char for node in node_layer), pinyin)
+                    if key not in blocks:
+                        if self.stats is not None:
+                            with self.stats.stage("transition"):
+                                blocks[key] = self.transition_block(list(key[0]), self.candidate_chars(pinyin))
+                        else:
+                            blocks[key] = self.transition_block(list(key[0]), self.candidate_chars(pinyin))
+                    new_layers[prefix] = self.step(node_layer, pinyin, k, blocks[key])
+                layers = new_layers
+            for i in indices:
+                # 三元模型中没有可达状态时整层为空（如合法音节的候选字都接不上），与 inference 一样返回 []
+                end_layer = layers[sentences[i]]
+                if end_layer:
+                    results[i] = list(map(lambda key: key.strip('<end>'), end_layer[0].topk_path.keys()))
+        return results
+
+    def decode_lattice(self, text: str, k: Optional[int] = None, abbreviations: bool = True, penalty: float = 8.0, \
+                       beam_width: int = 0) -> List[str]:
+        '''
+        解码未切分的拼音串（"womenshi"）或声母缩写（"wms"）：先由 SyllableIndex 建出音节网格，
+        再按字母位置做 Viterbi，到达同一位置、同一状态的不同切分合并为一个节点，只保留 top-k 路径，
+        因此切分方式再多，每个位置也只扩展一层。每条缩写边额外加 penalty 的代价，使完整拼写的音节优先；
+        beam_width > 0 时每个位置只保留最优路径代价最小的 beam_width 个节点（缩写输入的候选字很多时有用）。
+        '''
+        k = k or self.k
+        edges = self.syllables.lattice(text, abbreviations)
+        if not edges:
+            return []
+        layers: Dict[int, Dict[str, CharNode]] = {0: {'<start>': CharNode('<start>', {"": 0})}}
+        for i in range(len(edges) + 1):
+            if i not in layers:
+                continue
+            node_layer = self.prune_layer(layers.pop(i).values(), k, beam_width)
+            if i == len(edges):
+                return self.finish(node_layer, k)
+            for end, token, abbreviated in edges[i]:
+                self.merge_layer(layers.setdefault(end, {}), self.step(node_layer, token, k, self.cached_block(node_layer, token)), \
+                                 penalty if abbreviated else 0)
+        return []
+
+    @staticmethod
+    def prune_layer(nodes: Iterable[CharNode], k: int, beam_width: int = 0) -> List[CharNode]:
+        # 网格中合并出的一层：每个节点只保留 top-k 路径，去掉空节点；beam_width > 0 时只留最优代价最小的 beam_width 个节点
+        node_layer = []
+        for node in nodes:
+            node.topk_path = dict(sorted(node.topk_path.items(), key=lambda item: item[1])[:k])
+            if node.topk_path:
+                node_layer.append(node)
+        if beam_width and len(node_layer) > beam_width:
+            best = sorted(node_layer, key=lambda node: next(iter(node.topk_path.values())))[:beam_width]
+            node_layer = [node for node in node_layer if node in best]
+        return node_layer
+
+    @staticmethod
+    def merge_layer(target: Dict[str, CharNode], nodes: List[CharNode], extra: float = 0) -> None:
+        # 把从不同边到达同一位置的节点按状态合并进 target，同一路径取较小的代价
+        for node in nodes:
+            merged = target.setdefault(node.char, CharNode(node.char, {}))
+            for path, cost in node.topk_path.items():
+                if cost + extra < merged.topk_path.get(path, math.inf):
+                    merged.topk_path[path] = cost + extra
+
+    def finish(self, node_layer: List[CharNode], k: int) -> List[str]:
+        # 接上 <end> 并取出候选句
+        end_layer = self.step(node_layer, '<end>', k)
+        if not end_layer or not end_layer[0].topk_path:
+            return []
+        return list(map(lambda key: key.strip('<end>'), end_layer[0].topk_path.keys()))
+
+class DecodeSession:
+    '''
+    逐键输入的交互式解码会话：保存每个已输入拼音对应的一层网格，
+    push 只扩展一层，pop（退格）直接丢弃最后一层，candidates 时才临时接上 <end>，
+    因此每次按键的代价与句子长度无关。k 为会话中每个节点保留的路径数，即 candidates 可取到的最大候选数；
+    beam_width > 0 时每层只保留最优路径代价最小的 beam_width 个节点，进一步压低每次按键的延迟。
+    '''
+    def __init__(self, model: PinyinIMEModel, k: Optional[int] = None, beam_width: int = 0) -> None:
+        self.model = model
+        self.k = k or model.k
+        self.beam_width = beam_width
+        self.pinyins: List[str] = []
+        self.layers: List[List[CharNode]] = [[CharNode('<start>', {"": 0})]]
+
+    def __len__(self) -> int:
+        return len(self.pinyins)
+
+    def push(self, pinyin: str) -> None:
+        if pinyin == '<end>' or not self.model.candidate_chars(pinyin):
+            raise KeyError(f"unknown pinyin: {pinyin}")
+        block = self.model.cached_block(self.layers[-1], pinyin)
+        node_layer = self.model.step(self.layers[-1], pinyin, self.k, block)
+        self.layers.append(self.model.prune_layer(node_layer, self.k, self.beam_width))
+        self.pinyins.append(pinyin)
+
+    def pop(self) -> Optional[str]:
+        if not self.pinyins:
+            return None
+        self.layers.pop()
+        return self.pinyins.pop()
+
+    def clear(self) -> None:
+        del self.pinyins[:], self.layers[1:]
+
+    def candidates(self, k: Optional[int] = None) -> List[str]:
+        if not self.pinyins:
+            return []
+        end_layer = self.model.step(self.layers[-1], '<end>', self.k)
+        if not end_layer or not end_layer[0].topk_path:
+            return []
+        return list(map(lambda key: key.strip('<end>'), end_layer[0].topk_path.keys()))[:k or self.k]
+
 class BinaryModel(PinyinIMEModel):
+    ORDER = 2
+
     def __init__(self, k: int = 1, alpha: float = 0.99999, total: int = 100000, data_path: Path = ROOT / "src") -> None:
         super().__init__(k, total, data_path)
         self.alpha = alpha
-        with open(data_path / "binary_freq_table.pk", "rb") as f:
-            self.BINARY_FREQ_TABLE: Dict[str, Dict[str, int]] = pk.load(f)
 
     def calc_path_cost_wo_smoothing(self, last_node: CharNode, cur_node: CharNode) -> float:
-        try:
-            return -math.log(self.BINARY_FREQ_TABLE[last_node.char][cur_node.char] / self.CHAR_FREQ_TABLE[last_node.char])
-        except KeyError:
+        count = self.store.bigram_count(last_node.char, cur_node.char)
+        if not count:
             return math.inf
+        return -math.log(count / self.store.unigram_count(last_node.char))
     
     def calc_path_cost(self, last_node: CharNode, cur_node: CharNode) -> float:
         '''
@@ -62,61 +357,89 @@ class BinaryModel(PinyinIMEModel):
         Top5句准确率：66.07%
         Top10句准确率：71.06%
         '''
-        try:
-            p_cur_on_last = self.BINARY_FREQ_TABLE[last_node.char][cur_node.char] / self.CHAR_FREQ_TABLE[last_node.char]
-        except KeyError:
-            p_cur_on_last = 0
-        p_cur = self.CHAR_FREQ_TABLE[cur_node.char] / self.total if cur_node.char != '<end>' else 0
+        count = self.store.bigram_count(last_node.char, cur_node.char)
+        if self.stats is not None:
+            self.stats.lookup(count > 0)
+        p_cur_on_last = count / self.store.unigram_count(last_node.char) if count else 0
+        p_cur = self.store.unigram_count(cur_node.char) / self.total if cur_node.char != '<end>' else 0
         try:
             return -math.log(self.alpha * p_cur_on_last + (1 - self.alpha) * p_cur)
         except ValueError:
             return math.inf
     
+    def extend_layer(self, node_layer: List[CharNode], pinyin: str, k: Optional[int] = None, \
+                     block: Optional[List[List[float]]] = None) -> List[CharNode]:
+        k = k or self.k
+        new_node_layer: List[CharNode] = list(map(lambda char: CharNode(char, {}), self.candidate_chars(pinyin)))
+        for j, node in enumerate(new_node_layer):
+            for i, last_node in enumerate(node_layer):
+                path_cost = block[i][j] if block is not None else self.calc_path_cost(last_node, node)
+                if path_cost == math.inf:
+                    continue
+                # 同一路径串可能经不同的上一节点到达（如 WordModel 中的词“北京”与单字“北”+“京”），只保留代价较小的一条
+                topk_path = node.topk_path
+                for path, value in last_node.topk_path.items():
+                    path, value = path + node.char, value + path_cost
+                    if value < topk_path.get(path, math.inf):
+                        topk_path[path] = value
+        start = time.perf_counter() if self.stats is not None else 0
+        for node in new_node_layer:
+            # 将字典中的元素按值从小到大排序：利用key=lambda函数给出排序准则
+            node.topk_path = dict(sorted(node.topk_path.items(), key=lambda item: item[1]))
+            if len(node.topk_path) > k:
+                # 取出字典topk项：.items -> slice -> dict
+                node.topk_path = dict(list(node.topk_path.items())[:k])
+        if self.stats is not None:
+            self.stats.add_time("sort", time.perf_counter() - start)
+        return new_node_layer
+
     def inference(self, pinyin_sentence: List[str]) -> List[str]:
-        if not pinyin_sentence:             
-            return []         
-        pinyin_sentence.append('<end>')
-        for pinyin in pinyin_sentence:
-            new_node_layer: List[CharNode] = list(map(lambda char: CharNode(char, {}), self.PINYIN_TABLE[pinyin]))             
-            for node in new_node_layer:                 
-                for last_node in self.node_layer:                     
-                    path_cost = self.calc_path_cost(last_node, node) 
-                    if path_cost == math.inf:
-                        continue                   
-                    # dict将元组映射成字典中的键值对，实现对原始dict中的键、值同时更新的映射                     
-                    update_topk_path = dict(map(lambda path, value: (path + node.char, value + path_cost), \
-                                                 last_node.topk_path.keys(), last_node.topk_path.values()))                     
-                    # 字典的或运算 <=> 求并                     
-                    node.topk_path |= update_topk_path                 
-                # 将字典中的元素按值从小到大排序：利用key=lambda函数给出排序准则                 
-                node.topk_path = dict(sorted(node.topk_path.items(), key=lambda item: item[1]))                 
-                if len(node.topk_path) > self.k:                     
-                    # 取出字典topk项：.items -> slice -> dict                     
-                    node.topk_path = dict(list(node.topk_path.items())[:self.k])                 
-            self.node_layer = new_node_layer         
-        end_node = self.node_layer[0]         
-        # print(list(map(lambda key: key.strip("<end>"), end_node.topk_path.keys())))        
+        if not pinyin_sentence:
+            return []
+        if self.stats is not None:
+            self.stats.sentences += 1
+            with self.stats.stage("total"):
+                return self._inference(pinyin_sentence)
+        return self._inference(pinyin_sentence)
+
+    def _inference(self, pinyin_sentence: List[str]) -> List[str]:
+        if self.block_cache is not None or self.prefix_cache is not None:
+            return self.decode_cached(pinyin_sentence)
+        for pinyin in pinyin_sentence + ['<end>']:
+            self.node_layer = self.step(self.node_layer, pinyin)
+        if not self.node_layer:
+            return []
+        end_node = self.node_layer[0]
+        # print(list(map(lambda key: key.strip("<end>"), end_node.topk_path.keys())))
         return list(map(lambda key: key.strip('<end>'), end_node.topk_path.keys()))
     
 class TripleModel(BinaryModel):
+    ORDER = 3
+
     def __init__(self, k: int = 1, alpha: float = 0.99999, beta: float = 0.9, total: int = 100000, data_path: Path = ROOT / "src") -> None:
         super().__init__(k, alpha, total, data_path)
         self.beta = beta
-        with open(data_path / "triple_freq_table.pk", "rb") as f:
-            self.TRIPLE_FREQ_TABLE: Dict[str, Dict[str, Dict[str, int]]] = pk.load(f)
     
+    def next_state(self, last_char: str, char: str) -> str:
+        # 三元模型的状态为最近两个字；终止节点全都收束到一个<end>
+        if last_char == '<start>':
+            return last_char + char
+        if char == '<end>':
+            return char
+        return last_char[-1] + char
+
     def calc_path_cost_wo_smoothing(self, last_node: CharNode, cur_node: CharNode) -> float:
-        try:
-            if last_node.char == '<start>':
-                return -math.log(sum(self.TRIPLE_FREQ_TABLE['<start>'][cur_node.char].values()) / self.CHAR_FREQ_TABLE['<start>'])
-            elif last_node.char.startswith('<start>'):
-                return -math.log(self.TRIPLE_FREQ_TABLE['<start>'][last_node.char.strip('<start>')][cur_node.char] \
-                            / sum(self.TRIPLE_FREQ_TABLE['<start>'][last_node.char.strip('<start>')].values()))
-            else:
-                return -math.log(self.TRIPLE_FREQ_TABLE[last_node.char[0]][last_node.char[1]][cur_node.char] \
-                            / sum(self.TRIPLE_FREQ_TABLE[last_node.char[0]][last_node.char[1]].values()))
-        except KeyError:
+        if last_node.char == '<start>':
+            count = self.store.trigram_context_total('<start>', cur_node.char)
+            total = self.store.unigram_count('<start>')
+        else:
+            first, second = ('<start>', last_node.char.strip('<start>')) if last_node.char.startswith('<start>') \
+                                else (last_node.char[0], last_node.char[1])
+            count = self.store.trigram_count(first, second, cur_node.char)
+            total = self.store.trigram_context_total(first, second)
+        if not count:
             return math.inf
+        return -math.log(count / total)
     
     def calc_path_cost(self, last_node: CharNode, cur_node: CharNode) -> float:
         '''
@@ -128,15 +451,15 @@ class TripleModel(BinaryModel):
         '''
         last_first = last_node.char[0] if not last_node.char.startswith('<start>') else '<start>'
         last_second = last_node.char[-1] if last_node.char != '<start>' else '<start>'
-        try:
-            p_cur_on_last_two = self.TRIPLE_FREQ_TABLE[last_first][last_second][cur_node.char] / self.BINARY_FREQ_TABLE[last_first][last_second]
-        except KeyError:
-            p_cur_on_last_two = 0
-        try:
-            p_cur_on_last = self.BINARY_FREQ_TABLE[last_second][cur_node.char] / self.CHAR_FREQ_TABLE[last_second]
-        except KeyError:
-            p_cur_on_last = 0
-        p_cur = self.CHAR_FREQ_TABLE[cur_node.char] / self.total if cur_node.char != '<end>' else 0
+        tri_count = self.store.trigram_count(last_first, last_second, cur_node.char)
+        last_two_count = self.store.bigram_count(last_first, last_second)
+        p_cur_on_last_two = tri_count / last_two_count if tri_count and last_two_count else 0
+        bin_count = self.store.bigram_count(last_second, cur_node.char)
+        if self.stats is not None:
+            self.stats.lookup(tri_count > 0)
+            self.stats.lookup(bin_count > 0)
+        p_cur_on_last = bin_count / self.store.unigram_count(last_second) if bin_count else 0
+        p_cur = self.store.unigram_count(cur_node.char) / self.total if cur_node.char != '<end>' else 0
         p_bin = self.alpha * p_cur_on_last + (1 - self.alpha) * p_cur
         try:
             if last_node.char == '<start>':
@@ -146,36 +469,228 @@ class TripleModel(BinaryModel):
         except ValueError:
             return math.inf
         
-    def inference(self, pinyin_sentence: List[str]) -> List[str]:
-        if not pinyin_sentence:
-            return []
-        pinyin_sentence.append('<end>')
-        for pinyin in pinyin_sentence:
-            single_node_layer: List[CharNode] = list(map(lambda char: CharNode(char, {}), self.PINYIN_TABLE[pinyin]))
-            new_node_layer_dict: Dict[str, CharNode] = {}
-            for node in single_node_layer:
-                for last_node in self.node_layer:
-                    path_cost = self.calc_path_cost(last_node, node)
-                    if path_cost == math.inf:
-                        continue
-                    update_topk_path = dict(map(lambda path, value: (path + node.char, value + path_cost), \
-                                                last_node.topk_path.keys(), last_node.topk_path.values()))
-                    if last_node.char == '<start>':
-                        next_char = last_node.char + node.char
-                    elif node.char == '<end>':  # 注意单独处理终止节点的char，保证全都收束到一个<end>
-                        next_char = node.char
-                    else:
-                        next_char = last_node.char[-1] + node.char
-                    if next_char in new_node_layer_dict:
-                        new_node_layer_dict[next_char].topk_path |= update_topk_path
-                    else:
-                        new_node_layer_dict[next_char] = CharNode(next_char, update_topk_path)
-            new_node_layer = list(new_node_layer_dict.values())
-            for node in new_node_layer:
-                node.topk_path = dict(sorted(node.topk_path.items(), key=lambda item: item[1]))
-                if len(node.topk_path) > self.k:
-                    node.topk_path = dict(list(node.topk_path.items())[:self.k])
-            self.node_layer = new_node_layer
-        end_node = self.node_layer[0]
-        # print(list(map(lambda key: key.strip("<end>"), end_node.topk_path.keys())))
-        return list(map(lambda key: key.strip("<end>"), end_node.topk_path.keys()))
+    def extend_layer(self, node_layer: List[CharNode], pinyin: str, k: Optional[int] = None, \
+                     block: Optional[List[List[float]]] = None) -> List[CharNode]:
+        k = k or self.k
+        single_node_layer: List[CharNode] = list(map(lambda char: CharNode(char, {}), self.candidate_chars(pinyin)))
+        new_node_layer_dict: Dict[str, CharNode] = {}
+        for j, node in enumerate(single_node_layer):
+            for i, last_node in enumerate(node_layer):
+                path_cost = block[i][j] if block is not None else self.calc_path_cost(last_node, node)
+                if path_cost == math.inf:
+                    continue
+                update_topk_path = dict(map(lambda path, value: (path + node.char, value + path_cost), \
+                                            last_node.topk_path.keys(), last_node.topk_path.values()))
+                next_char = self.next_state(last_node.char, node.char)
+                if next_char in new_node_layer_dict:
+                    new_node_layer_dict[next_char].topk_path |= update_topk_path
+                else:
+                    new_node_layer_dict[next_char] = CharNode(next_char, update_topk_path)
+        new_node_layer = list(new_node_layer_dict.values())
+        start = time.perf_counter() if self.stats is not None else 0
+        for node in new_node_layer:
+            node.topk_path = dict(sorted(node.topk_path.items(), key=lambda item: item[1]))
+            if len(node.topk_path) > k:
+                node.topk_path = dict(list(node.topk_path.items())[:k])
+        if self.stats is not None:
+            self.stats.add_time("sort", time.perf_counter() - start)
+        return new_node_layer
+
+class CompiledBinaryModel(BinaryModel):
+    '''
+    与 BinaryModel 输出完全相同，但转移代价直接读取预编译的负对数概率表（见 store.CompiledStore）；
+    bits 为 8/16 时读取量化后的代价，内存更小但结果可能略有差异
+    '''
+    def __init__(self, k: int = 1, alpha: float = 0.99999, total: int = 100000, data_path: Path = ROOT / "src", bits: int = 0) -> None:
+        super().__init__(k, alpha, total, data_path)
+        self.bits = bits
+        self.compiled: CompiledStore = load_compiled(data_path, self.store, alpha, None, total, bits)
+
+    def reload(self) -> bool:
+        if not super().reload():
+            return False
+        self.compiled = load_compiled(self.data_path, self.store, self.alpha, None, self.total, self.bits)
+        return True
+
+    def calc_path_cost(self, last_node: CharNode, cur_node: CharNode) -> float:
+        ids = self.store.ids
+        a, b = ids.get(last_node.char, -1), ids.get(cur_node.char, -1)
+        if self.stats is not None:
+            self.stats.lookup(self.store.bigram_index(a, b) >= 0)
+        return self.compiled.binary_cost(a, b)
+
+class CompiledTripleModel(TripleModel):
+    '''
+    与 TripleModel 输出完全相同，但转移代价直接读取预编译的负对数概率表（见 store.CompiledStore）；
+    bits 为 8/16 时读取量化后的代价，内存更小但结果可能略有差异
+    '''
+    def __init__(self, k: int = 1, alpha: float = 0.99999, beta: float = 0.9, total: int = 100000, data_path: Path = ROOT / "src", \
+                 bits: int = 0) -> None:
+        super().__init__(k, alpha, beta, total, data_path)
+        self.bits = bits
+        self.compiled: CompiledStore = load_compiled(data_path, self.store, alpha, beta, total, bits)
+
+    def reload(self) -> bool:
+        if not super().reload():
+            return False
+        self.compiled = load_compiled(self.data_path, self.store, self.alpha, self.beta, self.total, self.bits)
+        return True
+
+    def calc_path_cost(self, last_node: CharNode, cur_node: CharNode) -> float:
+        ids = self.store.ids
+        cur = ids.get(cur_node.char, -1)
+        if last_node.char == '<start>':
+            if self.stats is not None:
+                self.stats.lookup(self.store.bigram_index(ids['<start>'], cur) >= 0)
+            return self.compiled.binary_cost(ids['<start>'], cur)
+        last_first = last_node.char[0] if not last_node.char.startswith('<start>') else '<start>'
+        a, b = ids.get(last_first, -1), ids.get(last_node.char[-1], -1)
+        if self.stats is not None:
+            self.stats.lookup(self.store.trigram_index(a, b, cur) >= 0)
+            self.stats.lookup(self.store.bigram_index(b, cur) >= 0)
+        return self.compiled.triple_cost(a, b, cur)
+
+    def transition_block(self, last_chars: List[str], chars: List[str]) -> List[List[float]]:
+        # 逐行计算：上文 (a, b) 的二元组下标每行只查一次，同一末字 b 的回退代价整行只算一次，
+        # 因此每个转移只在三元组行内做一次二分查找（回退行每个 (b, 候选字) 再各一次）
+        ids, store, compiled, stats = self.store.ids, self.store, self.compiled, self.stats
+        cur = [ids.get(char, -1) for char in chars]
+        start = ids['<start>']
+        backoff: Dict[int, List[float]] = {}
+        block: List[List[float]] = []
+        for last_char in last_chars:
+            if last_char == '<start>':
+                block.append([compiled.binary_cost(start, c) for c in cur])
+                if stats is not None:
+                    for c in cur:
+                        stats.lookup(store.bigram_index(start, c) >= 0)
+                continue
+            a = ids.get('<start>' if last_char.startswith('<start>') else last_char[0], -1)
+            b = ids.get(last_char[-1], -1)
+            if b not in backoff:
+                backoff[b] = compiled.backoff_row(b, cur)
+            block.append(compiled.triple_row(store.bigram_index(a, b), cur, backoff[b]))
+            if stats is not None:
+                for c in cur:
+                    stats.lookup(store.trigram_index(a, b, c) >= 0)
+                    stats.lookup(store.bigram_index(b, c) >= 0)
+        return block
+
+    def extend_layer(self, node_layer: List[CharNode], pinyin: str, k: Optional[int] = None, \
+                     block: Optional[List[List[float]]] = None) -> List[CharNode]:
+        # 没有传入矩阵时也按行整块计算，不逐对调用 calc_path_cost
+        if block is None:
+            block = self.transition_block([node.char for node in node_layer], self.candidate_chars(pinyin))
+        return super().extend_layer(node_layer, pinyin, k, block)
+
+class WordModel(BinaryModel):
+    '''
+    词级二元模型：状态为词，转移代价沿用 BinaryModel 的平滑公式，计数换成 dataprocess.py --words 统计的词频与词二元组（word_store.bin）。
+    多字词按拼音序列建成 trie，解码时从每个位置沿 trie 找出所有能组成词的拼音片段，一条边直接跨过整个词；
+    单字也是词，因此逐字的路径仍然存在，但常见词只需一次转移，网格中到达每个位置的状态也更少。
+    词边对应的"拼音"记为空格连接的音节（如 "qing hua"），extend_layer / step / cached_block 对它与单个音节一视同仁。
+    '''
+    STORE_FILE = "word_store.bin"
+    # 不超过 FULL_READINGS 个字的词展开全部读音组合；更长的词最多展开 MAX_READINGS 个组合
+    FULL_READINGS = 3
+    MAX_READINGS = 8
+
+    def __init__(self, k: int = 1, alpha: float = 0.99999, total: int = 100000, data_path: Path = ROOT / "src", \
+                 beam_width: int = 0) -> None:
+        super().__init__(k, alpha, total, data_path)
+        self.beam_width = beam_width
+        self.build_lexicon()
+
+    def open_store(self) -> NgramStore:
+        return NgramStore.open(self.data_path / self.STORE_FILE)
+
+    def reload(self) -> bool:
+        if not super().reload():
+            return False
+        self.build_lexicon()
+        return True
+
+    def build_lexicon(self) -> None:
+        # 每个字的读音由 PINYIN_TABLE 反查得到，词的读音为各字读音的组合
+        readings: Dict[str, List[str]] = defaultdict(list)
+        for pinyin, chars in self.PINYIN_TABLE.items():
+            if pinyin != '<end>':
+                for char in chars:
+                    readings[char].append(pinyin)
+        self.lexicon: Dict[str, List[str]] = defaultdict(list)
+        self.trie: Dict[str, dict] = {}
+        for word in self.store.chars:
+            if len(word) < 2 or not all(char in readings for char in word):
+                continue
+            for syllables in self.word_readings([readings[char] for char in word]):
+                key = " ".join(syllables)
+                self.lexicon[key].append(word)
+                node = self.trie
+                for syllable in syllables:
+                    node = node.setdefault(syllable, {})
+                node[_WORD] = key
+        self.lexicon = dict(self.lexicon)
+
+    def word_readings(self, options: List[List[str]]) -> Iterable[Tuple[str, ...]]:
+        '''
+        词的读音组合，options[i] 为第 i 个字的各读音。短词全部展开；长词按各字所取读音序号之和从小到大取前 MAX_READINGS 个，
+        每个字的其他读音都有机会出现，而不是按字典序截断时只轮换最后几个字的读音
+        '''
+        if len(options) <= self.FULL_READINGS:
+            return product(*options)
+        picks = heapq.nsmallest(self.MAX_READINGS, product(*(range(len(option)) for option in options)), key=sum)
+        return [tuple(option[i] for option, i in zip(options, pick)) for pick in picks]
+
+    def calc_path_cost(self, last_node: CharNode, cur_node: CharNode) -> float:
+        '''
+        与 BinaryModel 相同的插值平滑；<end> 的一元频数取句数（<start> 的频数），
+        使没见过的 (词, <end>) 也有有限代价，不会因为句尾的词而整句不可达
+        '''
+        count = self.store.bigram_count(last_node.char, cur_node.char)
+        if self.stats is not None:
+            self.stats.lookup(count > 0)
+        p_cur_on_last = count / self.store.unigram_count(last_node.char) if count else 0
+        cur = cur_node.char if cur_node.char != '<end>' else '<start>'
+        p_cur = self.store.unigram_count(cur) / self.total
+        try:
+            return -math.log(self.alpha * p_cur_on_last + (1 - self.alpha) * p_cur)
+        except ValueError:
+            return math.inf
+
+    def candidate_chars(self, pinyin: str) -> List[str]:
+        if " " in pinyin:
+            return self.lexicon.get(pinyin, [])
+        return super().candidate_chars(pinyin)
+
+    def word_edges(self, pinyin_sentence: List[str], start: int) -> Iterator[Tuple[int, str]]:
+        # 从 start 出发的边 (结束位置, 拼音)：单个音节，以及 trie 中能组成多字词的音节序列
+        yield start + 1, pinyin_sentence[start]
+        node = self.trie
+        for end in range(start, len(pinyin_sentence)):
+            node = node.get(pinyin_sentence[end])
+            if node is None:
+                return
+            if _WORD in node and end > start:
+                yield end + 1, node[_WORD]
+
+    def _decode_batch(self, pinyin_sentences: List[List[str]], k: Optional[int] = None) -> List[List[str]]:
+        # 词边跨越多个位置，句子之间无法按位置同步共享网格，逐句解码
+        return [self._inference(sentence, k) if sentence else [] for sentence in pinyin_sentences]
+
+    def _inference(self, pinyin_sentence: List[str], k: Optional[int] = None) -> List[str]:
+        '''
+        按音节位置做 Viterbi：到达同一位置、同一词的路径合并为一个节点，只保留 top-k 路径；
+        beam_width > 0 时每个位置只保留最优路径代价最小的 beam_width 个节点。不读写 self.node_layer
+        '''
+        k = k or self.k
+        layers: Dict[int, Dict[str, CharNode]] = {0: {'<start>': CharNode('<start>', {"": 0})}}
+        for i in range(len(pinyin_sentence) + 1):
+            if i not in layers:
+                continue
+            node_layer = self.prune_layer(layers.pop(i).values(), k, self.beam_width)
+            if i == len(pinyin_sentence):
+                return self.finish(node_layer, k)
+            for end, pinyin in self.word_edges(pinyin_sentence, i):
+                self.merge_layer(layers.setdefault(end, {}), \
+                                 self.step(node_layer, pinyin, k, self.cached_block(node_layer, pinyin)))
+        return []
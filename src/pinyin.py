@@ -1,9 +1,12 @@
 from __future__ import annotations
-import os, math, json
+import os, math, json, cProfile
+import multiprocessing
+from multiprocessing import Pool
 from pathlib import Path
-from typing import List, Dict, Callable
+from typing import List, Tuple, Callable, Optional
 from tqdm import tqdm
-from models import BinaryModel, TripleModel
+from models import PinyinIMEModel, BinaryModel, TripleModel, CompiledBinaryModel, CompiledTripleModel, WordModel
+from instrument import DecodeStats
 from argparse import ArgumentParser
 
 ROOT = Path(__file__).parent.parent
@@ -46,6 +49,12 @@ def parse_args():
         help="Model type: Binary Model (2) / Triple Model (3)",
         default=2
     )
+    parser.add_argument(
+        "--words",
+        action="store_true",
+        dest="words",
+        help="Use the word-level bigram model (word_store.bin from dataprocess.py --words) instead of -m"
+    )
     parser.add_argument(
         "-k",
         type=int,
@@ -74,42 +83,245 @@ def parse_args():
         help="Estimated total character number in the training corpus",
         default=1000000
     )
+    parser.add_argument(
+        "--compiled",
+        action="store_true",
+        dest="compiled",
+        help="Use precompiled log-probability tables (same outputs, faster)"
+    )
+    parser.add_argument(
+        "-e", "--engine",
+        type=str,
+        choices=["python", "numpy", "beam"],
+        dest="engine",
+        help="Decoding engine: pure Python (python) / vectorized NumPy (numpy) / k-best beam search (beam)",
+        default="python"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        dest="batch_size",
+        help="Decode this many lines per decode_batch call (0: line by line)",
+        default=0
+    )
+    parser.add_argument(
+        "-q", "--quantize",
+        type=int,
+        choices=[0, 8, 16],
+        dest="quantize",
+        help="Use 8/16-bit quantized compiled costs (implies --compiled; 0: exact)",
+        default=0
+    )
+    parser.add_argument(
+        "--beam-width",
+        type=int,
+        dest="beam_width",
+        help="Keep at most this many states per layer in the beam engine / per position with --segment or --words (0: unlimited)",
+        default=0
+    )
+    parser.add_argument(
+        "--beam-threshold",
+        type=float,
+        dest="beam_threshold",
+        help="Prune paths whose cost exceeds the layer's best by this margin in the beam engine",
+        default=math.inf
+    )
+    parser.add_argument(
+        "-w", "--workers",
+        type=int,
+        dest="workers",
+        help="Evaluate the input in parallel with this many processes (0: serial)",
+        default=0
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        dest="cache_size",
+        help="LRU cache capacity for transition matrices, in matrix cells (0: off)",
+        default=0
+    )
+    parser.add_argument(
+        "--prefix-cache-size",
+        type=int,
+        dest="prefix_cache_size",
+        help="LRU cache capacity for lattice layers of pinyin prefixes, in paths (0: off)",
+        default=0
+    )
+    parser.add_argument(
+        "-s", "--segment",
+        action="store_true",
+        dest="segment",
+        help="Input lines are unsegmented or abbreviated pinyin (e.g. womenshi / wms); segment them with the syllable lattice"
+    )
+    parser.add_argument(
+        "--no-abbreviations",
+        action="store_false",
+        dest="abbreviations",
+        help="With --segment, only accept fully spelled syllables (no initials or unfinished syllables)"
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        dest="profile",
+        help="Collect decoding statistics (transitions, layer widths, pruned paths, lookups, time per stage) and print a summary"
+    )
+    parser.add_argument(
+        "--profile-dump",
+        type=str,
+        dest="profile_dump",
+        help="Also run the evaluation under cProfile and dump pstats to this path (runs serially)",
+        default=""
+    )
     args = parser.parse_args()
-    return args.input, args.output, args.std_output, args.corpus, args.model, args.k, args.alpha, args.beta, args.total
+    if args.words and args.engine != "python":
+        # NumpyDecoder / BeamDecoder 按音节逐层解码，走不到跨越多个音节的词边
+        parser.error("--words only supports the python engine")
+    if args.words and args.segment:
+        # decode_lattice 的音节网格只有单字边，词典中的词边会被丢掉
+        parser.error("--words cannot be combined with --segment")
+    return args.input, args.output, args.std_output, args.corpus, args.model, args.k, args.alpha, args.beta, args.total, \
+           args.compiled, args.engine, args.batch_size, args.quantize, args.beam_width, args.beam_threshold, args.workers, \
+           args.cache_size, args.prefix_cache_size, args.profile, args.profile_dump, args.segment, args.words, \
+           args.abbreviations
+
+def build_model(model_type: int, k: int, alpha: float, beta: float, total: int, data_path: Path, compiled: bool = False, \
+                bits: int = 0, words: bool = False, beam_width: int = 0) -> PinyinIMEModel:
+    if words:
+        return WordModel(k, alpha, total, data_path, beam_width)
+    if model_type == 2:
+        if compiled or bits:
+            return CompiledBinaryModel(k, alpha, total, data_path, bits)
+        return BinaryModel(k, alpha, total, data_path)
+    assert model_type == 3
+    if compiled or bits:
+        return CompiledTripleModel(k, alpha, beta, total, data_path, bits)
+    return TripleModel(k, alpha, beta, total, data_path)
+
+def score(results: List[str], answer: str) -> List[int]:
+    # [正确字数, Top1正确句数, Topk正确句数, 总字数, 总句数]；没有解码结果（如 --segment 下切不出音节）时记为全错
+    top1 = (results or [""])[0]
+    return [sum(map(lambda c1, c2: c1 == c2, top1, answer)), int(bool(results) and top1 == answer), \
+            sum(result == answer for result in results), len(answer), 1]
+
+def format_results(results: List[str], k: int) -> str:
+    # k == 1 时只输出首选；没有结果时输出空行
+    if not results:
+        return ""
+    return str(results[0]) if k == 1 else str(results)
+
+def print_accuracy(counts: List[int], k: int) -> None:
+    correct_char_count, correct_line_count_top1, correct_line_count_topk, total_char, total_line = counts
+    print(f"字准确率：{(correct_char_count / total_char) * 100:.2f}%")
+    print(f"Top1句准确率：{(correct_line_count_top1 / total_line) * 100:.2f}%")
+    print(f"Top{k}句准确率：{(correct_line_count_topk / total_line) * 100:.2f}%")
+
+def make_decoder(model: PinyinIMEModel, engine: str = "python", batch_size: int = 0, beam_width: int = 0, \
+                 beam_threshold: float = math.inf, segment: bool = False, abbreviations: bool = True) \
+        -> Callable[[List[str]], List[List[str]]]:
+    # 返回 lines -> 每行候选列表 的解码函数
+    if segment:
+        return lambda lines: [model.decode_lattice(line.strip(), abbreviations=abbreviations, beam_width=beam_width) \
+                              for line in lines]
+    if engine == "numpy":
+        from decoder import NumpyDecoder
+        inference = NumpyDecoder(model).inference
+    elif engine == "beam":
+        from decoder import BeamDecoder
+        inference = BeamDecoder(model, beam_width, beam_threshold).inference
+    else:
+        inference = model.inference
+
+    def decode(lines: List[str]) -> List[List[str]]:
+        if batch_size and engine == "python":
+            return model.decode_batch([line.strip().split(" ") for line in lines])
+        results = []
+        for line in lines:
+            model.reset()
+            results.append(inference(line.strip().split(" ")))
+        return results
+    return decode
+
+# 每个进程只加载一次模型；fork 启动时子进程直接继承父进程中已加载（mmap）的表
+_model: Optional[PinyinIMEModel] = None
+_decode: Optional[Callable[[List[str]], List[List[str]]]] = None
+
+def init_worker(model_args: tuple, decoder_args: tuple, cache_args: Tuple[int, int] = (0, 0), profile: bool = False) -> None:
+    global _model, _decode
+    _model = build_model(*model_args)
+    _model.set_cache(*cache_args)
+    _model.enable_stats(profile)
+    _decode = make_decoder(_model, *decoder_args)
+
+def evaluate_chunk(chunk: Tuple[List[str], List[str]]) -> Tuple[List[List[str]], List[int], Optional[DecodeStats]]:
+    lines, answers = chunk
+    results = _decode(lines)
+    counts = [0, 0, 0, 0, 0]
+    for result, answer in zip(results, answers):
+        counts = list(map(sum, zip(counts, score(result, answer.strip()))))
+    # 每个分块的统计随结果一起返回，由主进程合并
+    stats = _model.stats
+    if stats is not None:
+        _model.enable_stats()
+    return results, counts, stats
 
 if __name__ == "__main__":
-    input, output, std_output, corpus, model_type, k, alpha, beta, total = parse_args()
+    input, output, std_output, corpus, model_type, k, alpha, beta, total, compiled, engine, batch_size, quantize, \
+        beam_width, beam_threshold, workers, cache_size, prefix_cache_size, profile, profile_dump, segment, words, \
+        abbreviations = parse_args()
     input, output, std_output = Path(input), Path(output), Path(std_output)
     data_path = ROOT / "src"
     if corpus:
         data_path = data_path / corpus
-    if model_type == 2:
-        model = BinaryModel(k, alpha, total, data_path)
-    else:
-        assert model_type == 3
-        model = TripleModel(k, alpha, beta, total, data_path)
-    correct_char_count, correct_line_count_top1, correct_line_count_topk = 0, 0, 0
-    total_char, total_line = 0, 0
-    
+    model_args = (model_type, k, alpha, beta, total, data_path, compiled, quantize, words, beam_width)
+    decoder_args = (engine, batch_size, beam_width, beam_threshold, segment, abbreviations)
+    cache_args = (cache_size, prefix_cache_size)
+    init_worker(model_args, decoder_args, cache_args, profile)
+    counts = [0, 0, 0, 0, 0]
+    run_stats = DecodeStats()
+    if profile_dump and workers:
+        print("--profile-dump runs serially, ignoring --workers")
+        workers = 0
+    profiler = cProfile.Profile() if profile_dump else None
+
     with open(input, "r") as fin:
-        with open(output, "w") as fout:
-            with open(std_output, "r", encoding="utf8") as std:
-                for line in tqdm(fin.readlines()):
-                    model.reset()
-                    results = model.inference(line.strip().split(" "))
-                    answer = std.readline().strip()
-                    
-                    total_line += 1
-                    correct_line_count_top1 += (results[0] == answer)
-                    correct_line_count_topk += sum(result == answer for result in results)
-                    total_char += len(answer)
-                    correct_char_count += sum(map(lambda c1, c2: c1 == c2, results[0], answer))
-                    
-                    if k == 1:
-                        fout.write(str(results[0]) + '\n')
-                    else:
-                        fout.write(str(results) + '\n')
-                
-    print(f"字准确率：{(correct_char_count / total_char) * 100:.2f}%")
-    print(f"Top1句准确率：{(correct_line_count_top1 / total_line) * 100:.2f}%")
-    print(f"Top{k}句准确率：{(correct_line_count_topk / total_line) * 100:.2f}%")
\ No newline at end of file
+        lines = fin.readlines()
+    with open(std_output, "r", encoding="utf8") as std:
+        answers = std.read().split("\n")[:len(lines)]
+    answers += [""] * (len(lines) - len(answers))
+    step = batch_size or (1 if not workers else max(1, min(64, len(lines) // (workers * 8))))
+    chunks = [(lines[start:start + step], answers[start:start + step]) for start in range(0, len(lines), step)]
+    with open(output, "w") as fout:
+        if workers:
+            # imap 按提交顺序返回，输出顺序与输入一致
+            fork = multiprocessing.get_start_method() == "fork"
+            initargs = () if fork else (model_args, decoder_args, cache_args, profile)
+            with Pool(workers, initializer=None if fork else init_worker, initargs=initargs) as pool:
+                evaluated = pool.imap(evaluate_chunk, chunks)
+                for results_chunk, chunk_counts, chunk_stats in tqdm(evaluated, total=len(chunks)):
+                    counts = list(map(sum, zip(counts, chunk_counts)))
+                    if chunk_stats is not None:
+                        run_stats.merge(chunk_stats)
+                    for results in results_chunk:
+                        fout.write(format_results(results, k) + '\n')
+        else:
+            if profiler is not None:
+                profiler.enable()
+            for chunk in tqdm(chunks):
+                results_chunk, chunk_counts, chunk_stats = evaluate_chunk(chunk)
+                counts = list(map(sum, zip(counts, chunk_counts)))
+                if chunk_stats is not None:
+                    run_stats.merge(chunk_stats)
+                for results in results_chunk:
+                    fout.write(format_results(results, k) + '\n')
+            if profiler is not None:
+                profiler.disable()
+                # pstats 格式：可用 python -m pstats / snakeviz 查看，或用 flameprof 生成火焰图
+                profiler.dump_stats(profile_dump)
+                print(f"cProfile stats written to {profile_dump}")
+
+    print_accuracy(counts, k)
+    if profile:
+        print(run_stats.report())
+    if not workers:
+        for name, stats in _model.cache_stats().items():
+            print(f"{name} cache: {json.dumps(stats)}")
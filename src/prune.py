@@ -0,0 +1,161 @@
+from __future__ import annotations
+import os, time, shutil
+from pathlib import Path
+from typing import List, Dict, Tuple
+from argparse import ArgumentParser
+from store import NgramStore, CompiledStore, load_store
+from dataprocess import prune_store
+from pinyin import build_model, score
+
+ROOT = Path(__file__).parent.parent
+
+def parse_variant(spec: str) -> Dict[str, float]:
+    # "bi_cutoff=2,tri_cutoff=2" -> {"bi_cutoff": 2, "tri_cutoff": 2}；"base" 表示不剪枝
+    if spec == "base":
+        return {}
+    options = {}
+    for item in spec.split(","):
+        key, value = item.split("=")
+        options[key] = float(value) if key == "entropy" else int(value)
+    return options
+
+def build_variant(store: NgramStore, data_path: Path, spec: str, alpha: float, beta: float, total: int) -> Tuple[Path, NgramStore]:
+    # 每个剪枝版本单独放在 pruned/<spec> 目录下，可直接用 pinyin.py -c <corpus>/pruned/<spec> 加载
+    variant_path = data_path / "pruned" / spec.replace("=", "-").replace(",", "_")
+    os.makedirs(variant_path, exist_ok=True)
+    shutil.copy(data_path / "pinyin_table.pk", variant_path / "pinyin_table.pk")
+    pruned = prune_store(store, alpha=alpha, beta=beta, total=total, **parse_variant(spec))
+    pruned.save(variant_path / "ngram_store.bin")
+    return variant_path, pruned
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument(
+        "-c", "--corpus",
+        type=str,
+        dest="corpus",
+        help="Corpus data to be pruned",
+        default=""
+    )
+    parser.add_argument(
+        "--variants",
+        type=str,
+        nargs="+",
+        dest="variants",
+        help="Pruning variants, e.g. base bi_cutoff=2,tri_cutoff=2 top_n=20 entropy=1e-4",
+        default=["base", "bi_cutoff=2,tri_cutoff=2", "top_n=20", "entropy=1e-4"]
+    )
+    parser.add_argument(
+        "-i", "--input",
+        type=str,
+        dest="input",
+        help="Input pinyin file path",
+        default="../data/input.txt"
+    )
+    parser.add_argument(
+        "-d", "--std-output",
+        type=str,
+        dest="std_output",
+        help="Standard output file (answer) path",
+        default="../data/std_output.txt"
+    )
+    parser.add_argument(
+        "-m", "--model",
+        type=int,
+        choices=[2, 3],
+        dest="model",
+        help="Model type",
+        default=3
+    )
+    parser.add_argument(
+        "-k",
+        type=int,
+        dest="k",
+        help="Top k choice",
+        default=3
+    )
+    parser.add_argument(
+        "-a", "--alpha",
+        type=float,
+        dest="alpha",
+        help="Smoothing factor in Binary Model",
+        default=0.99999
+    )
+    parser.add_argument(
+        "-b", "--beta",
+        type=float,
+        dest="beta",
+        help="Smoothing factor in Triple Model",
+        default=0.9
+    )
+    parser.add_argument(
+        "-t", "--total",
+        type=int,
+        dest="total",
+        help="Estimated total character number",
+        default=1000000
+    )
+    parser.add_argument(
+        "--compiled",
+        action="store_true",
+        dest="compiled",
+        help="Evaluate the compiled model variants"
+    )
+    parser.add_argument(
+        "-q", "--quantize",
+        type=int,
+        nargs="+",
+        choices=[0, 8, 16],
+        dest="quantize",
+        help="Also evaluate every variant with 8/16-bit quantized compiled costs (0: exact)",
+        default=[0]
+    )
+    parser.add_argument(
+        "-n", "--lines",
+        type=int,
+        dest="lines",
+        help="Only evaluate the first n lines (0: all)",
+        default=0
+    )
+    args = parser.parse_args()
+
+    data_path = ROOT / "src" / args.corpus if args.corpus else ROOT / "src"
+    store = load_store(data_path, triple=args.model >= 3)
+    with open(args.input, "r") as f:
+        lines = f.read().strip().split("\n")
+    with open(args.std_output, "r", encoding="utf8") as f:
+        answers = f.read().strip().split("\n")
+    if args.lines:
+        lines, answers = lines[:args.lines], answers[:args.lines]
+
+    rows: List[List[str]] = []
+    for spec in args.variants:
+        # 每个剪枝版本只剪枝、编译一次，各量化位数共用
+        variant_path, pruned = build_variant(store, data_path, spec, args.alpha, args.beta, args.total)
+        compiled = CompiledStore.compile(pruned, args.alpha, args.beta if args.model >= 3 else None, args.total) \
+                        if args.compiled or any(args.quantize) else None
+        for bits in args.quantize:
+            size = os.path.getsize(variant_path / "ngram_store.bin")
+            if compiled is not None and (args.compiled or bits):
+                # 先写好参数匹配的 compiled_store.bin，load(ms) 测的是映射而不是现场编译
+                (compiled.quantize(bits) if bits else compiled).save(variant_path / "compiled_store.bin")
+                size += os.path.getsize(variant_path / "compiled_store.bin")
+            start = time.perf_counter()
+            model = build_model(args.model, args.k, args.alpha, args.beta, args.total, variant_path, args.compiled, bits)
+            load_time = time.perf_counter() - start
+            counts = [0, 0, 0, 0, 0]
+            start = time.perf_counter()
+            for line, answer in zip(lines, answers):
+                model.reset()
+                results = model.inference(line.strip().split(" ")) or [""]
+                counts = list(map(sum, zip(counts, score(results, answer))))
+            latency = (time.perf_counter() - start) / len(lines)
+            correct_char_count, correct_line_count_top1, correct_line_count_topk, total_char, total_line = counts
+            rows.append([spec, str(bits or "exact"), str(len(model.store.bi_keys)), str(len(model.store.tri_keys)), f"{size / 2**20:.2f}", \
+                         f"{load_time * 1000:.1f}", f"{latency * 1000:.2f}", f"{correct_char_count / total_char * 100:.2f}%", \
+                         f"{correct_line_count_top1 / total_line * 100:.2f}%", f"{correct_line_count_topk / total_line * 100:.2f}%"])
+
+    header = ["variant", "bits", "bigrams", "trigrams", "size(MB)", "load(ms)", "ms/sent", "字准确率", "Top1句准确率", f"Top{args.k}句准确率"]
+    widths = [max(len(row[i]) for row in rows + [header]) for i in range(len(header))]
+    for row in [header] + rows:
+        print("  ".join(cell.ljust(width) for cell, width in zip(row, widths)))
@@ -0,0 +1,83 @@
+from __future__ import annotations
+from bisect import bisect_right
+from collections import defaultdict
+from typing import List, Dict, Tuple, Iterator
+
+# 声母（含零声母音节常用的 y / w）；缩写输入按声母切分，如 "qhdx" -> q* h* d* x*
+INITIALS = ("zh", "ch", "sh", "b", "p", "m", "f", "d", "t", "n", "l", "g", "k", "h", "j", "q", "x", "r", "z", "c", "s", "y", "w")
+SEPARATORS = " '"
+_SYLLABLE = "$"
+
+class SyllableIndex:
+    '''
+    PINYIN_TABLE 音节的 trie 与前缀索引：
+        trie 用于在未切分的拼音串中找出所有完整音节；
+        prefix_chars[p] 为所有以 p 开头的音节的候选字并集（按音节字母序、去重），
+        缩写 / 未打完的音节（记作 "p*"）在网格中只占一条边、一层候选字，不会按可能的音节个数成倍展开。
+    '''
+    def __init__(self, pinyin_table: Dict[str, List[str]]) -> None:
+        self.trie: Dict[str, dict] = {}
+        prefix_chars: Dict[str, Dict[str, None]] = defaultdict(dict)
+        for syllable in sorted(pinyin_table):
+            if not syllable.isalpha():
+                continue
+            node = self.trie
+            for i, letter in enumerate(syllable):
+                node = node.setdefault(letter, {})
+                prefix_chars[syllable[:i + 1]].update(dict.fromkeys(pinyin_table[syllable]))
+            node[_SYLLABLE] = syllable
+        self.prefix_chars: Dict[str, List[str]] = {prefix: list(chars) for prefix, chars in prefix_chars.items()}
+
+    def syllable_ends(self, letters: str, start: int) -> Iterator[int]:
+        # 从 start 开始能组成完整音节的所有结束位置
+        node = self.trie
+        for end in range(start, len(letters)):
+            node = node.get(letters[end])
+            if node is None:
+                return
+            if _SYLLABLE in node:
+                yield end + 1
+
+    def lattice(self, text: str, abbreviations: bool = True) -> List[List[Tuple[int, str, bool]]]:
+        '''
+        将拼音串切分成音节网格：edges[i] 为从第 i 个字母出发的边 (结束位置, 音节或缩写, 是否为缩写)。
+        空格与 ' 为强制分界，边不能跨过分界；缩写边为声母，以及分界前 / 串尾未打完的音节前缀。
+        缩写边的候选字是许多音节的并集，只加在完整音节切不到分界的位置上；能整段切成完整音节的片段
+        （如 "qinghuadaxue"）没有缩写边，完整拼写的输入不承担缩写的代价。
+        '''
+        letters, boundaries = [], {0}
+        for c in text.lower():
+            if c in SEPARATORS:
+                boundaries.add(len(letters))
+            elif c.isalpha():
+                letters.append(c)
+        letters = "".join(letters)
+        n = len(letters)
+        boundaries.add(n)
+        bounds = sorted(boundaries)
+        edges: List[List[Tuple[int, str, bool]]] = [[] for _ in range(n)]
+        for i in range(n):
+            limit = bounds[bisect_right(bounds, i)]
+            for end in self.syllable_ends(letters, i):
+                if end <= limit:
+                    edges[i].append((end, letters[i:end], False))
+        if not abbreviations:
+            return edges
+        # spelled[i]：从 i 起只用完整音节就能切到下一个分界
+        spelled = [True] * (n + 1)
+        for i in range(n - 1, -1, -1):
+            spelled[i] = any(end in boundaries or spelled[end] for end, _, _ in edges[i])
+        for i in range(n):
+            j = bisect_right(bounds, i)
+            start, limit = bounds[j - 1], bounds[j]
+            if spelled[start] or spelled[i]:
+                continue
+            seen = {end for end, _, _ in edges[i]}
+            for initial in INITIALS:
+                end = i + len(initial)
+                if end <= limit and end not in seen and letters.startswith(initial, i) and initial in self.prefix_chars:
+                    edges[i].append((end, initial + "*", True))
+                    seen.add(end)
+            if limit not in seen and letters[i:limit] in self.prefix_chars:
+                edges[i].append((limit, letters[i:limit] + "*", True))
+        return edges
@@ -0,0 +1,348 @@
+from __future__ import annotations
+import os, time, json, signal, asyncio
+import pickle as pk
+from pathlib import Path
+from collections import deque, defaultdict
+from typing import List, Dict, Tuple, Optional
+from urllib.parse import urlsplit, parse_qs
+from argparse import ArgumentParser
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from models import PinyinIMEModel
+from pinyin import build_model
+
+ROOT = Path(__file__).parent.parent
+
+# 每个工作进程（或 --workers 0 时的解码线程）各自持有一份只读模型；ngram_store.bin 以 mmap 打开，多个进程共享同一份页缓存
+_model: Optional[PinyinIMEModel] = None
+
+def init_worker(model_args: tuple, ignore_sigint: bool = False) -> None:
+    global _model
+    if ignore_sigint:
+        # Ctrl-C 只由主进程处理（停止服务后 shutdown 进程池），工作进程不应各自抛出 KeyboardInterrupt
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _model = build_model(*model_args)
+
+def decode_batch(sentences: List[List[str]], k: int) -> List[List[str]]:
+    # 在工作进程中执行：模型文件有更新时先热加载
+    _model.reload()
+    return _model.decode_batch(sentences, k)
+
+class LatencyStats:
+    '''
+    记录最近 window 个请求的延迟，给出 p50 / p99 与吞吐量
+    '''
+    def __init__(self, window: int = 10000) -> None:
+        self.latencies: deque = deque(maxlen=window)
+        self.requests = 0
+        self.batches = 0
+        self.batched_requests = 0
+        self.start = time.perf_counter()
+
+    def record(self, latency: float) -> None:
+        self.latencies.append(latency)
+        self.requests += 1
+
+    def record_batch(self, size: int) -> None:
+        self.batches += 1
+        self.batched_requests += size
+
+    def summary(self) -> Dict[str, float]:
+        latencies = sorted(self.latencies)
+        percentile = lambda p: latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else 0.0
+        elapsed = time.perf_counter() - self.start
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "mean_batch_size": self.batched_requests / self.batches if self.batches else 0.0,
+            "p50_ms": percentile(0.5),
+            "p99_ms": percentile(0.99),
+            "throughput_rps": self.requests / elapsed if elapsed else 0.0,
+            "uptime_s": elapsed,
+        }
+
+class DecodeServer:
+    '''
+    asyncio 解码服务：
+        每个请求放入队列，由 batcher 合并成批；只有在有空闲 worker 时才取出一批，
+        因此 worker 忙时并发到来的请求会自然攒成更大的批，再按 k 分组交给 model.decode_batch；
+        解码在进程池（或单个线程）中执行，不阻塞事件循环。
+    HTTP 接口：
+        POST /decode  {"pinyin": "qing hua da xue", "k": 3}  ->  {"candidates": [...], "latency_ms": ...}
+        GET  /decode?pinyin=qing+hua+da+xue&k=3
+        GET  /stats   ->  p50 / p99 延迟、吞吐量、平均批大小
+    '''
+    def __init__(self, executor: Executor, pinyins: set, k: int, workers: int = 1, max_batch: int = 16, \
+                 max_wait: float = 0.002, max_k: int = 50) -> None:
+        self.executor = executor
+        self.pinyins = pinyins
+        self.k = k
+        self.max_k = max_k
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.slots = asyncio.Semaphore(max(workers, 1))
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.stats = LatencyStats()
+        # 正在执行的 dispatch 任务；事件循环只持有任务的弱引用，需在这里保留到任务结束
+        self.tasks: set = set()
+
+    async def decode(self, sentence: List[str], k: int) -> List[str]:
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((sentence, k, future))
+        return await future
+
+    async def collect(self) -> List[tuple]:
+        loop = asyncio.get_running_loop()
+        items = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(items) < self.max_batch:
+            if not self.queue.empty():
+                items.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                items.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return items
+
+    async def batcher(self) -> None:
+        while True:
+            await self.slots.acquire()
+            items = await self.collect()
+            task = asyncio.ensure_future(self.dispatch(items))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def dispatch(self, items: List[tuple]) -> None:
+        loop = asyncio.get_running_loop()
+        self.stats.record_batch(len(items))
+        by_k: Dict[int, List[tuple]] = defaultdict(list)
+        for item in items:
+            by_k[item[1]].append(item)
+        try:
+            for k, group in by_k.items():
+                results = await loop.run_in_executor(self.executor, decode_batch, [item[0] for item in group], k)
+                for (_, _, future), result in zip(group, results):
+                    if not future.done():
+                        future.set_result(result)
+        except Exception as e:
+            for _, _, future in items:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self.slots.release()
+
+    async def route(self, method: str, target: str, body: bytes) -> Tuple[str, dict]:
+        url = urlsplit(target)
+        if url.path == "/stats" and method == "GET":
+            return "200 OK", self.stats.summary()
+        if url.path != "/decode" or method not in ("GET", "POST"):
+            return "404 Not Found", {"error": f"no route for {method} {url.path}"}
+        if method == "POST":
+            request = json.loads(body.decode("utf8") or "{}")
+        else:
+            request = {key: values[0] for key, values in parse_qs(url.query).items()}
+        pinyin = request.get("pinyin", "")
+        sentence = pinyin.split() if isinstance(pinyin, str) else list(pinyin)
+        unknown = [syllable for syllable in sentence if syllable not in self.pinyins]
+        if unknown:
+            return "400 Bad Request", {"error": f"unknown pinyin: {' '.join(unknown)}"}
+        k = int(request.get("k", self.k))
+        if not 1 <= k <= self.max_k:
+            return "400 Bad Request", {"error": f"k must be between 1 and {self.max_k}"}
+        start = time.perf_counter()
+        candidates = await self.decode(sentence, k) if sentence else []
+        latency = time.perf_counter() - start
+        self.stats.record(latency)
+        return "200 OK", {"candidates": candidates, "latency_ms": latency * 1000}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        # 极简的 HTTP/1.1：支持 Content-Length 与 keep-alive，足够本机上的调用方使用
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers: Dict[str, str] = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                try:
+                    status, payload = await self.route(method, target, body)
+                except ValueError as e:
+                    status, payload = "400 Bad Request", {"error": str(e)}
+                except Exception as e:
+                    status, payload = "500 Internal Server Error", {"error": repr(e)}
+                data = json.dumps(payload, ensure_ascii=False).encode("utf8")
+                writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json; charset=utf-8\r\n"
+                             f"Content-Length: {len(data)}\r\n\r\n".encode("latin-1") + data)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+async def serve(server: DecodeServer, host: str, port: int, unix: str, report_interval: float) -> None:
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    if unix:
+        listener = await asyncio.start_unix_server(server.handle, path=unix)
+        print(f"Serving on unix:{unix}")
+    else:
+        listener = await asyncio.start_server(server.handle, host, port)
+        print(f"Serving on http://{host}:{port}")
+    batcher = asyncio.ensure_future(server.batcher())
+    async with listener:
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), report_interval if report_interval > 0 else None)
+            except asyncio.TimeoutError:
+                print(json.dumps(server.stats.summary()))
+    batcher.cancel()
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument(
+        "-c", "--corpus",
+        type=str,
+        dest="corpus",
+        help="Corpus data to be used",
+        default=""
+    )
+    parser.add_argument(
+        "-m", "--model",
+        type=int,
+        choices=[2, 3],
+        dest="model",
+        help="Model type",
+        default=2
+    )
+    parser.add_argument(
+        "-k",
+        type=int,
+        dest="k",
+        help="Default top k choice",
+        default=3
+    )
+    parser.add_argument(
+        "-a", "--alpha",
+        type=float,
+        dest="alpha",
+        help="Smoothing factor in Binary Model",
+        default=0.99999
+    )
+    parser.add_argument(
+        "-b", "--beta",
+        type=float,
+        dest="beta",
+        help="Smoothing factor in Triple Model",
+        default=0.9
+    )
+    parser.add_argument(
+        "-t", "--total",
+        type=int,
+        dest="total",
+        help="Estimated total character number",
+        default=1000000
+    )
+    parser.add_argument(
+        "--max-k",
+        type=int,
+        dest="max_k",
+        help="Largest k a request may ask for",
+        default=50
+    )
+    parser.add_argument(
+        "--compiled",
+        action="store_true",
+        dest="compiled",
+        help="Use precompiled log-probability tables"
+    )
+    parser.add_argument(
+        "-q", "--quantize",
+        type=int,
+        choices=[0, 8, 16],
+        dest="quantize",
+        help="Quantized compiled costs",
+        default=0
+    )
+    parser.add_argument(
+        "--host",
+        type=str,
+        dest="host",
+        help="Listen address",
+        default="127.0.0.1"
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        dest="port",
+        help="Listen port",
+        default=8765
+    )
+    parser.add_argument(
+        "--unix",
+        type=str,
+        dest="unix",
+        help="Listen on this Unix socket path instead of TCP",
+        default=""
+    )
+    parser.add_argument(
+        "-w", "--workers",
+        type=int,
+        dest="workers",
+        help="Decoding processes (0: one thread in the server process)",
+        default=1
+    )
+    parser.add_argument(
+        "--max-batch",
+        type=int,
+        dest="max_batch",
+        help="Maximum requests coalesced into one batch",
+        default=16
+    )
+    parser.add_argument(
+        "--max-wait-ms",
+        type=float,
+        dest="max_wait_ms",
+        help="How long to wait for more requests to batch",
+        default=2.0
+    )
+    parser.add_argument(
+        "--report-interval",
+        type=float,
+        dest="report_interval",
+        help="Print latency stats every N seconds (0: off)",
+        default=0
+    )
+    args = parser.parse_args()
+
+    data_path = ROOT / "src" / args.corpus if args.corpus else ROOT / "src"
+    model_args = (args.model, args.k, args.alpha, args.beta, args.total, data_path, args.compiled, args.quantize)
+    with open(data_path / "pinyin_table.pk", "rb") as f:
+        pinyins = set(pk.load(f)) - {'<end>'}
+    if args.workers > 0:
+        executor = ProcessPoolExecutor(args.workers, initializer=init_worker, initargs=(model_args, True))
+    else:
+        executor = ThreadPoolExecutor(1, initializer=init_worker, initargs=(model_args,))
+    # 先让每个 worker 加载好模型，避免第一批请求承担加载时间
+    list(executor.map(decode_batch, [[]] * max(args.workers, 1), [args.k] * max(args.workers, 1)))
+    server = DecodeServer(executor, pinyins, args.k, args.workers, args.max_batch, args.max_wait_ms / 1000, args.max_k)
+    try:
+        asyncio.run(serve(server, args.host, args.port, args.unix, args.report_interval))
+    finally:
+        print(json.dumps(server.stats.summary()))
+        executor.shutdown()
+        if args.unix and os.path.exists(args.unix):
+            os.remove(args.unix)
@@ -0,0 +1,475 @@
+from __future__ import annotations
+import os, sys, math, mmap, zlib, struct
+import pickle as pk
+from array import array
+from bisect import bisect_left
+from pathlib import Path
+from typing import List, Dict, Optional, Union
+from argparse import ArgumentParser
+
+START, END = '<start>', '<end>'
+
+# 模型文件格式：
+#   header   : magic(8s) version(I) byteorder(I) n_sections(q)
+#   sections : n_sections 个目录项 name(16s) typecode(1s) offset(q) count(q)
+#   payload  : 各段数据按 8 字节对齐依次存放，可直接 mmap 后 cast 成定长数组
+MAGIC = b"PYIMESTR"
+FORMAT_VERSION = 1
+_HEADER = struct.Struct("<8sIIq")
+_SECTION = struct.Struct("<16s1s7xqq")
+_ALIGN = 8
+
+def write_model_file(path: Path, sections: Dict[str, Union[array, bytes]]) -> None:
+    entries, offset = [], _HEADER.size + _SECTION.size * len(sections)
+    for name, data in sections.items():
+        if len(name.encode()) > 16:
+            raise ValueError(f"Section name {name!r} is longer than 16 bytes")
+        typecode = data.typecode if isinstance(data, array) else 'B'
+        offset += -offset % _ALIGN
+        entries.append((name, typecode, offset, len(data)))
+        offset += len(data) * (data.itemsize if isinstance(data, array) else 1)
+    # 先写临时文件再原子替换，正在映射旧文件的进程不受影响；临时文件名带 pid，多个进程同时写同一文件时互不覆盖
+    tmp_path = Path(f"{path}.{os.getpid()}.tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, FORMAT_VERSION, sys.byteorder == "big", len(sections)))
+        for name, typecode, offset, count in entries:
+            f.write(_SECTION.pack(name.encode(), typecode.encode(), offset, count))
+        for (name, typecode, offset, count), data in zip(entries, sections.values()):
+            f.write(b"\0" * (offset - f.tell()))
+            f.write(data.tobytes() if isinstance(data, array) else data)
+    os.replace(tmp_path, path)
+
+def open_model_file(path: Path) -> Dict[str, memoryview]:
+    # 只读映射整个文件，各段以 memoryview 零拷贝返回；页面由操作系统按需载入并在进程间共享
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mm)
+    magic, version, big_endian, n_sections = _HEADER.unpack_from(view, 0)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a PinyinIME model file")
+    if version != FORMAT_VERSION:
+        raise ValueError(f"{path} has format version {version}, expected {FORMAT_VERSION}")
+    if big_endian != (sys.byteorder == "big"):
+        raise ValueError(f"{path} was written on a machine with different byte order")
+    sections = {}
+    for i in range(n_sections):
+        name, typecode, offset, count = _SECTION.unpack_from(view, _HEADER.size + i * _SECTION.size)
+        typecode = typecode.decode()
+        size = count * struct.calcsize(typecode)
+        sections[name.rstrip(b"\0").decode()] = view[offset:offset + size].cast(typecode)
+    return sections
+
+def _narrow(values) -> array:
+    # ID / 计数 / 偏移都是非负整数：按最大值选最窄的无符号类型写盘，读取时类型由段目录给出
+    top = max(values, default=0)
+    return array('H' if top < 1 << 16 else 'I' if top < 1 << 32 else 'q', values)
+
+def _find(keys: array, lo: int, hi: int, key: int) -> int:
+    # 在有序区间 keys[lo:hi] 中二分查找 key，返回下标，找不到返回 -1
+    i = bisect_left(keys, key, lo, hi)
+    return i if i < hi and keys[i] == key else -1
+
+class NgramStore:
+    '''
+    以整数ID + 有序数组（CSR）存储的 n-gram 频数表，取代嵌套 dict：
+        chars[i]                          : ID 为 i 的字符（含 <start> / <end>）
+        unigram[i]                        : 字频
+        bi_offsets[a]:bi_offsets[a+1]     : 以 a 开头的二元组在 bi_keys / bi_counts 中的区间
+        tri_offsets[e]:tri_offsets[e+1]   : 以第 e 个二元组为上文的三元组在 tri_keys / tri_counts 中的区间
+    '''
+    def __init__(self, chars: List[str], unigram: array, bi_offsets: array, bi_keys: array, bi_counts: array, \
+                 tri_offsets: array, tri_keys: array, tri_counts: array) -> None:
+        self.chars = chars
+        self.ids: Dict[str, int] = {c: i for i, c in enumerate(chars)}
+        self.unigram = unigram
+        self.bi_offsets = bi_offsets
+        self.bi_keys = bi_keys
+        self.bi_counts = bi_counts
+        self.tri_offsets = tri_offsets
+        self.tri_keys = tri_keys
+        self.tri_counts = tri_counts
+
+    def __len__(self) -> int:
+        return len(self.chars)
+
+    @property
+    def has_triple(self) -> bool:
+        return len(self.tri_keys) > 0
+
+    def fingerprint(self) -> List[int]:
+        # 用于判断编译表等派生文件是否由当前频数表生成：各维度大小 + 按写盘格式计算的全部段内容的 CRC32，
+        # 形状相同而计数不同的频数表也能区分。映射打开的 store 直接对 memoryview 求校验和，不拷贝
+        crc = zlib.crc32("\0".join(self.chars).encode("utf8"))
+        for values in (self.unigram, self.bi_offsets, self.bi_keys, self.bi_counts, self.tri_offsets, self.tri_keys, self.tri_counts):
+            crc = zlib.crc32(values if isinstance(values, memoryview) else _narrow(values), crc)
+        return [len(self.chars), len(self.bi_keys), len(self.tri_keys), sum(self.unigram), crc]
+
+    def char_id(self, char: str) -> int:
+        return self.ids.get(char, -1)
+
+    def bigram_index(self, a: int, b: int) -> int:
+        if a < 0 or b < 0:
+            return -1
+        return _find(self.bi_keys, self.bi_offsets[a], self.bi_offsets[a + 1], b)
+
+    def trigram_index(self, a: int, b: int, c: int) -> int:
+        e = self.bigram_index(a, b)
+        if e < 0 or c < 0 or not self.has_triple:
+            return -1
+        return _find(self.tri_keys, self.tri_offsets[e], self.tri_offsets[e + 1], c)
+
+    def unigram_count(self, char: str) -> int:
+        i = self.ids.get(char, -1)
+        return self.unigram[i] if i >= 0 else 0
+
+    def bigram_count(self, first: str, second: str) -> int:
+        e = self.bigram_index(self.ids.get(first, -1), self.ids.get(second, -1))
+        return self.bi_counts[e] if e >= 0 else 0
+
+    def trigram_count(self, first: str, second: str, third: str) -> int:
+        t = self.trigram_index(self.ids.get(first, -1), self.ids.get(second, -1), self.ids.get(third, -1))
+        return self.tri_counts[t] if t >= 0 else 0
+
+    def trigram_context_total(self, first: str, second: str) -> int:
+        e = self.bigram_index(self.ids.get(first, -1), self.ids.get(second, -1))
+        if e < 0 or not self.has_triple:
+            return 0
+        return sum(self.tri_counts[self.tri_offsets[e]:self.tri_offsets[e + 1]])
+
+    @classmethod
+    def from_tables(cls, char_table: Dict[str, int], binary_table: Dict[str, Dict[str, int]], \
+                    triple_table: Optional[Dict[str, Dict[str, Dict[str, int]]]] = None) -> NgramStore:
+        triple_table = triple_table or {}
+        chars: List[str] = list(char_table.keys())
+        ids: Dict[str, int] = {c: i for i, c in enumerate(chars)}
+        # 频数表中可能出现字表以外的符号（如 <start> / <end>），统一分配ID
+        def add(char: str) -> None:
+            if char not in ids:
+                ids[char] = len(chars)
+                chars.append(char)
+        for symbol in (START, END):
+            add(symbol)
+        for first, row in binary_table.items():
+            add(first)
+            for second in row:
+                add(second)
+        for first, rows in triple_table.items():
+            add(first)
+            for second, row in rows.items():
+                add(second)
+                for third in row:
+                    add(third)
+
+        unigram = array('q', (char_table.get(c, 0) for c in chars))
+        bi_offsets, bi_keys, bi_counts = array('q', [0]), array('i'), array('q')
+        tri_offsets, tri_keys, tri_counts = array('q', [0]), array('i'), array('q')
+        for first in chars:
+            bin_row = binary_table.get(first, {})
+            tri_rows = triple_table.get(first, {})
+            # 三元组的上文若不在二元表中，也要占一个（频数为0的）二元组位置
+            for b in sorted({ids[c] for c in bin_row} | {ids[c] for c in tri_rows}):
+                second = chars[b]
+                bi_keys.append(b)
+                bi_counts.append(bin_row.get(second, 0))
+                tri_row = tri_rows.get(second, {})
+                for c in sorted(ids[third] for third in tri_row):
+                    tri_keys.append(c)
+                    tri_counts.append(tri_row[chars[c]])
+                tri_offsets.append(len(tri_keys))
+            bi_offsets.append(len(bi_keys))
+        return cls(chars, unigram, bi_offsets, bi_keys, bi_counts, tri_offsets, tri_keys, tri_counts)
+
+    @classmethod
+    def from_pickles(cls, data_path: Path, triple: bool = True) -> NgramStore:
+        with open(data_path / "char_freq_table.pk", "rb") as f:
+            char_table = pk.load(f)
+        with open(data_path / "binary_freq_table.pk", "rb") as f:
+            binary_table = pk.load(f)
+        triple_table = None
+        if triple:
+            with open(data_path / "triple_freq_table.pk", "rb") as f:
+                triple_table = pk.load(f)
+        return cls.from_tables(char_table, binary_table, triple_table)
+
+    def sections(self) -> Dict[str, Union[array, bytes]]:
+        return {
+            "chars": "\0".join(self.chars).encode("utf8"),
+            "unigram": _narrow(self.unigram),
+            "bi_offsets": _narrow(self.bi_offsets),
+            "bi_keys": _narrow(self.bi_keys),
+            "bi_counts": _narrow(self.bi_counts),
+            "tri_offsets": _narrow(self.tri_offsets),
+            "tri_keys": _narrow(self.tri_keys),
+            "tri_counts": _narrow(self.tri_counts),
+        }
+
+    def save(self, path: Path) -> None:
+        write_model_file(path, self.sections())
+
+    @classmethod
+    def open(cls, path: Path) -> NgramStore:
+        sections = open_model_file(path)
+        chars = bytes(sections["chars"]).decode("utf8").split("\0")
+        return cls(chars, sections["unigram"], sections["bi_offsets"], sections["bi_keys"], sections["bi_counts"], \
+                   sections["tri_offsets"], sections["tri_keys"], sections["tri_counts"])
+
+def load_store(data_path: Path, triple: bool = True) -> NgramStore:
+    # 优先映射二进制模型文件；不存在时从旧的 pickle 频数表转换
+    store_path = data_path / "ngram_store.bin"
+    if store_path.exists():
+        store = NgramStore.open(store_path)
+        if store.has_triple or not triple:
+            return store
+    return NgramStore.from_pickles(data_path, triple)
+
+def _neg_log(p: float) -> float:
+    try:
+        return -math.log(p)
+    except ValueError:
+        return math.inf
+
+class QuantizedArray:
+    '''
+    以 8/16 位码字 + 码本存储的浮点数组，按下标取值时查码本解码；最后一个码字保留给 inf
+    '''
+    def __init__(self, codes: array, codebook: array) -> None:
+        self.codes = codes
+        self.codebook = codebook
+
+    def __getitem__(self, i: int) -> float:
+        return self.codebook[self.codes[i]]
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    @classmethod
+    def quantize(cls, values: array, bits: int) -> QuantizedArray:
+        # 等频分箱取箱内均值作为码本，每个值映射到最近的码字
+        finite = sorted(v for v in values if v != math.inf)
+        n_bins = min((1 << bits) - 1, len(finite))
+        bounds = [len(finite) * i // n_bins for i in range(n_bins + 1)] if n_bins else [0]
+        centers = sorted(set(sum(finite[lo:hi]) / (hi - lo) for lo, hi in zip(bounds, bounds[1:]) if hi > lo))
+        mids = [(low + high) / 2 for low, high in zip(centers, centers[1:])]
+        inf_code = len(centers)
+        codes = array('B' if bits <= 8 else 'H', (bisect_left(mids, v) if v != math.inf else inf_code for v in values))
+        return cls(codes, array('d', centers + [math.inf]))
+
+COST_TABLES = ("uni_cost", "bi_cost", "uni_tri_cost", "bi_tri_cost", "tri_cost")
+
+class CompiledStore:
+    '''
+    针对给定 (alpha, beta, total) 预先算好的平滑负对数概率，与 NgramStore 的数组一一对应：
+        bi_cost[e]       : 二元组 e=(a,b) 的代价 -log(alpha * P(b|a) + (1-alpha) * P(b))
+        uni_cost[b]      : 未出现二元组 (*,b) 的回退代价 -log((1-alpha) * P(b))
+        tri_cost[t]      : 三元组 t=(a,b,c) 的代价 -log(beta * P(c|ab) + (1-beta) * P_bin(c|b))
+        bi_tri_cost[e]   : 未出现三元组 (*,b,c) 但二元组 e=(b,c) 出现时的回退代价 -log((1-beta) * P_bin(c|b))
+        uni_tri_cost[c]  : 三元组与二元组都未出现时的回退代价 -log((1-beta) * (1-alpha) * P(c))
+    beta 为 None 时只编译二元部分；bits 为 8/16 时各表以 QuantizedArray 存储（每表一个码本），0 为精确的 double。
+    '''
+    def __init__(self, store: NgramStore, params: array, uni_cost: array, bi_cost: array, \
+                 uni_tri_cost: array, bi_tri_cost: array, tri_cost: array) -> None:
+        self.store = store
+        self.alpha, self.beta, self.total = params[:3]
+        self.bits = int(params[3]) if len(params) > 3 else 0
+        self.uni_cost = uni_cost
+        self.bi_cost = bi_cost
+        self.uni_tri_cost = uni_tri_cost
+        self.bi_tri_cost = bi_tri_cost
+        self.tri_cost = tri_cost
+
+    def binary_cost(self, a: int, b: int) -> float:
+        if b < 0:
+            return math.inf
+        e = self.store.bigram_index(a, b)
+        return self.bi_cost[e] if e >= 0 else self.uni_cost[b]
+
+    def triple_cost(self, a: int, b: int, c: int) -> float:
+        if c < 0:
+            return math.inf
+        t = self.store.trigram_index(a, b, c)
+        if t >= 0:
+            return self.tri_cost[t]
+        e = self.store.bigram_index(b, c)
+        return self.bi_tri_cost[e] if e >= 0 else self.uni_tri_cost[c]
+
+    def backoff_row(self, b: int, cs: List[int]) -> List[float]:
+        # 上文末字为 b 时各候选字 cs 的回退代价，与 triple_cost 未命中三元组时的取值相同；同一 b 的各行共用
+        row = []
+        for c in cs:
+            if c < 0:
+                row.append(math.inf)
+                continue
+            e = self.store.bigram_index(b, c)
+            row.append(self.bi_tri_cost[e] if e >= 0 else self.uni_tri_cost[c])
+        return row
+
+    def triple_row(self, e: int, cs: List[int], backoff: List[float]) -> List[float]:
+        # e 为上文 (a, b) 的二元组下标，由调用方每个上文查一次；每个候选字只在该上文的三元组行内二分查找一次，未命中时取 backoff
+        if e < 0 or not self.store.has_triple:
+            return list(backoff)
+        tri_keys, lo, hi = self.store.tri_keys, self.store.tri_offsets[e], self.store.tri_offsets[e + 1]
+        row = []
+        for c, cost in zip(cs, backoff):
+            t = _find(tri_keys, lo, hi, c) if c >= 0 else -1
+            row.append(self.tri_cost[t] if t >= 0 else cost)
+        return row
+
+    def matches(self, alpha: float, beta: Optional[float], total: int, bits: int = 0) -> bool:
+        if self.alpha != alpha or self.total != total or self.bits != bits:
+            return False
+        return beta is None or (self.beta == beta and len(self.tri_cost) == len(self.store.tri_keys))
+
+    @classmethod
+    def compile(cls, store: NgramStore, alpha: float, beta: Optional[float], total: int) -> CompiledStore:
+        # 插值公式与 BinaryModel / TripleModel.calc_path_cost 逐项保持一致，保证结果完全相同
+        end = store.char_id(END)
+        p_uni = [store.unigram[c] / total if c != end else 0 for c in range(len(store))]
+        p_bin = array('d', bytes(8 * len(store.bi_keys)))
+        for a in range(len(store)):
+            for e in range(store.bi_offsets[a], store.bi_offsets[a + 1]):
+                count = store.bi_counts[e]
+                p_bin[e] = alpha * (count / store.unigram[a] if count else 0) + (1 - alpha) * p_uni[store.bi_keys[e]]
+        uni_p_bin = [alpha * 0 + (1 - alpha) * p for p in p_uni]
+        uni_cost = array('d', map(_neg_log, uni_p_bin))
+        bi_cost = array('d', map(_neg_log, p_bin))
+        uni_tri_cost, bi_tri_cost, tri_cost = array('d'), array('d'), array('d')
+        if beta is not None and store.has_triple:
+            uni_tri_cost.extend(_neg_log(beta * 0 + (1 - beta) * p) for p in uni_p_bin)
+            bi_tri_cost.extend(_neg_log(beta * 0 + (1 - beta) * p) for p in p_bin)
+            for e in range(len(store.bi_keys)):
+                b, context_count = store.bi_keys[e], store.bi_counts[e]
+                for t in range(store.tri_offsets[e], store.tri_offsets[e + 1]):
+                    c, count = store.tri_keys[t], store.tri_counts[t]
+                    p_cur_on_last_two = count / context_count if count and context_count else 0
+                    e_bc = store.bigram_index(b, c)
+                    p = p_bin[e_bc] if e_bc >= 0 else uni_p_bin[c]
+                    tri_cost.append(_neg_log(beta * p_cur_on_last_two + (1 - beta) * p))
+        params = array('d', [alpha, math.nan if beta is None else beta, total])
+        return cls(store, params, uni_cost, bi_cost, uni_tri_cost, bi_tri_cost, tri_cost)
+
+    def quantize(self, bits: int) -> CompiledStore:
+        if bits not in (8, 16):
+            raise ValueError(f"Unsupported quantization bits: {bits}")
+        params = array('d', [self.alpha, self.beta, self.total, bits])
+        return CompiledStore(self.store, params, *(QuantizedArray.quantize(getattr(self, name), bits) for name in COST_TABLES))
+
+    def save(self, path: Path) -> None:
+        sections = {
+            "params": array('d', [self.alpha, self.beta, self.total, self.bits]),
+            "shape": array('q', self.store.fingerprint()),
+        }
+        for name in COST_TABLES:
+            table = getattr(self, name)
+            if isinstance(table, QuantizedArray):
+                sections[name + ".q"] = table.codes
+                sections[name + ".cb"] = table.codebook
+            else:
+                sections[name] = table
+        write_model_file(path, sections)
+
+    @classmethod
+    def open(cls, path: Path, store: NgramStore) -> CompiledStore:
+        sections = open_model_file(path)
+        if list(sections["shape"]) != store.fingerprint():
+            raise ValueError(f"{path} was compiled from a different n-gram store")
+        try:
+            tables = [sections[name] if name in sections else QuantizedArray(sections[name + ".q"], sections[name + ".cb"]) \
+                        for name in COST_TABLES]
+        except KeyError as e:
+            raise ValueError(f"{path} is missing section {e}")
+        return cls(store, sections["params"], *tables)
+
+def load_compiled(data_path: Path, store: NgramStore, alpha: float, beta: Optional[float], total: int, bits: int = 0) -> CompiledStore:
+    # 参数一致时直接映射 compiled_store.bin；文件缺失、过期或参数不同时重新编译（并按需量化），写回后再映射，
+    # 下次启动 / 热加载时不必再编译
+    compiled_path = data_path / "compiled_store.bin"
+    if compiled_path.exists():
+        try:
+            compiled = CompiledStore.open(compiled_path, store)
+            if compiled.matches(alpha, beta, total, bits):
+                return compiled
+            reason = f"it was compiled with alpha={compiled.alpha}, beta={compiled.beta}, total={compiled.total:g}, bits={compiled.bits}"
+        except ValueError as e:
+            reason = str(e)
+        print(f"Warning: cannot use {compiled_path} ({reason}); recompiling it", file=sys.stderr)
+    compiled = CompiledStore.compile(store, alpha, beta, total)
+    if bits:
+        compiled = compiled.quantize(bits)
+    try:
+        compiled.save(compiled_path)
+    except OSError as e:
+        print(f"Warning: cannot write {compiled_path} ({e}); using the tables compiled in memory", file=sys.stderr)
+        return compiled
+    return CompiledStore.open(compiled_path, store)
+
+if __name__ == '__main__':
+    # 将已有的 *.pk 频数表转换为 ngram_store.bin（已存在时直接打开），可选地再编译出 compiled_store.bin
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--data",
+        type=str,
+        dest="data",
+        help="Directory containing char/binary/triple freq table pickles",
+        default=str(Path(__file__).parent)
+    )
+    parser.add_argument(
+        "--no-triple",
+        action="store_true",
+        dest="no_triple",
+        help="Skip the triple freq table"
+    )
+    parser.add_argument(
+        "--convert",
+        action="store_true",
+        dest="convert",
+        help="Rebuild ngram_store.bin from the *.pk tables even if it already exists"
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        dest="compile",
+        help="Also bake smoothed log-probabilities into compiled_store.bin"
+    )
+    parser.add_argument(
+        "-a", "--alpha",
+        type=float,
+        dest="alpha",
+        help="Smoothing factor in Binary Model",
+        default=0.99999
+    )
+    parser.add_argument(
+        "-b","--beta",
+        type=float,
+        dest="beta",
+        help="Smoothing factor in Triple Model",
+        default=0.9
+    )
+    parser.add_argument(
+        "-t","--total",
+        type=int,
+        dest="total",
+        help="Estimated total character number in the training corpus",
+        default=1000000
+    )
+    parser.add_argument(
+        "-q", "--quantize",
+        type=int,
+        choices=[0, 8, 16],
+        dest="quantize",
+        help="Store the compiled costs as 8/16-bit codes with a per-table codebook (0: exact doubles)",
+        default=0
+    )
+    args = parser.parse_args()
+    data_path = Path(args.data)
+    if (data_path / "ngram_store.bin").exists() and not args.convert:
+        store = NgramStore.open(data_path / "ngram_store.bin")
+    else:
+        store = NgramStore.from_pickles(data_path, triple=not args.no_triple)
+        store.save(data_path / "ngram_store.bin")
+    print(f"{len(store)} chars, {len(store.bi_keys)} bigrams, {len(store.tri_keys)} trigrams -> {data_path / 'ngram_store.bin'}")
+    if args.compile:
+        compiled = CompiledStore.compile(store, args.alpha, None if args.no_triple else args.beta, args.total)
+        if args.quantize:
+            compiled = compiled.quantize(args.quantize)
+        compiled.save(data_path / "compiled_store.bin")
+        print(f"alpha={args.alpha}, beta={args.beta}, total={args.total}, bits={args.quantize} -> {data_path / 'compiled_store.bin'}")
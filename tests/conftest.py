@@ -0,0 +1,50 @@
+import sys
+from pathlib import Path
+import pytest
+
+ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT / "src"))
+
+import benchmark
+
+CORPUS_LINES = 300
+
+@pytest.fixture(scope="session")
+def chars():
+    return benchmark.table_chars()
+
+@pytest.fixture(scope="session")
+def corpus(tmp_path_factory):
+    # 与 sina_news_gbk 同格式的合成语料（gbk 编码的 JSON lines）
+    path = tmp_path_factory.mktemp("corpus") / "corpus.txt"
+    benchmark.make_corpus(path, CORPUS_LINES, 0)
+    return path
+
+@pytest.fixture(scope="session")
+def model_dir(corpus, chars, tmp_path_factory):
+    # 由合成语料构建的 ngram_store.bin 与 pinyin_table.pk，供各模型 / 解码器的测试使用
+    import pickle as pk
+    import dataprocess as dp
+    path = tmp_path_factory.mktemp("model")
+    unigram, bi_runs, tri_runs = dp.count_corpus_streaming([corpus], ["title", "html"], "gbk", chars, path / "spill", 1 << 20)
+    store, = dp.build_stores_from_runs(chars, unigram, [dp.run_stream(run) for run in bi_runs], \
+                                       [dp.run_stream(run) for run in tri_runs])
+    store.save(path / "ngram_store.bin")
+    pinyin_table = dp.build_pinyin_table(ROOT / "table" / "拼音汉字表.txt")
+    pinyin_table['<end>'] = ['<end>']
+    with open(path / "pinyin_table.pk", "wb") as f:
+        pk.dump(pinyin_table, f)
+    return path
+
+@pytest.fixture(scope="session")
+def examples():
+    # data/input.txt 中较短的几句及其答案；合成语料由 data/std_output.txt 生成，因此都能解码出结果
+    with open(ROOT / "data" / "input.txt", "r") as f:
+        lines = [line.split() for line in f]
+    with open(ROOT / "data" / "std_output.txt", "r", encoding="utf8") as f:
+        answers = [line.strip() for line in f]
+    return [(line, answer) for line, answer in zip(lines, answers) if line and len(line) <= 6][:5]
+
+@pytest.fixture(scope="session")
+def sentences(examples):
+    return [line for line, _ in examples]
@@ -0,0 +1,115 @@
+import math
+import pytest
+from models import BinaryModel, TripleModel, CompiledBinaryModel, CompiledTripleModel
+from decoder import NumpyDecoder, BeamDecoder
+
+K = 3
+
+def reference(model, sentences):
+    results = []
+    for sentence in sentences:
+        model.reset()
+        results.append(model.inference(sentence))
+    return results
+
+@pytest.fixture(scope="module", params=[2, 3])
+def model_and_expected(request, model_dir, sentences):
+    # 各解码路径都应与逐句的 model.inference 给出完全相同的 top-k 候选
+    model = BinaryModel(K, 0.99999, 1000000, model_dir) if request.param == 2 \
+                else TripleModel(K, 0.99999, 0.9, 1000000, model_dir)
+    expected = reference(model, sentences)
+    assert all(expected)
+    return model, expected
+
+def test_compiled_model(model_and_expected, model_dir, sentences):
+    model, expected = model_and_expected
+    compiled = CompiledBinaryModel(K, 0.99999, 1000000, model_dir) if model.ORDER == 2 \
+                    else CompiledTripleModel(K, 0.99999, 0.9, 1000000, model_dir)
+    assert reference(compiled, sentences) == expected
+
+def test_numpy_decoder(model_and_expected, sentences):
+    pytest.importorskip("numpy")
+    model, expected = model_and_expected
+    decoder = NumpyDecoder(model)
+    assert [decoder.inference(sentence) for sentence in sentences] == expected
+
+def test_beam_decoder(model_and_expected, sentences):
+    model, expected = model_and_expected
+    beam = BeamDecoder(model, 0, math.inf)
+    assert [beam.inference(sentence) for sentence in sentences] == expected
+
+def test_decode_batch(model_and_expected, sentences):
+    model, expected = model_and_expected
+    assert model.decode_batch(sentences + [[]], K) == expected + [[]]
+
+def test_session(model_and_expected, sentences):
+    model, expected = model_and_expected
+    results = []
+    for sentence in sentences:
+        session = model.session()
+        for pinyin in sentence + ["a"]:
+            session.push(pinyin)
+        # 退格后的候选与直接输入完整拼音相同
+        assert session.pop() == "a"
+        results.append(session.candidates())
+    assert results == expected
+
+def test_cached(model_and_expected, sentences):
+    model, expected = model_and_expected
+    model.set_cache(1 << 20, 1 << 16)
+    try:
+        # 第二遍命中前缀缓存与转移矩阵缓存，结果仍与不用缓存时一致
+        assert reference(model, sentences) == expected
+        assert reference(model, sentences) == expected
+    finally:
+        model.set_cache(0, 0)
+
+def test_word_model(model_dir, corpus, chars, examples, tmp_path):
+    import shutil
+    import dataprocess as dp
+    from models import WordModel
+    shutil.copy(model_dir / "pinyin_table.pk", tmp_path)
+    dp.build_word_store([corpus], ["title", "html"], "gbk", chars[:-2], 4, 5, 3.0).save(tmp_path / "word_store.bin")
+    model = WordModel(K, 0.99999, 1000000, tmp_path)
+    sentences = [line for line, _ in examples]
+    expected = [model.inference(sentence) for sentence in sentences]
+    # 语料中的句子应解码回原句：同一路径串经词边与单字边到达时必须保留代价较小的一条
+    assert [result[0] for result in expected] == [answer for _, answer in examples]
+    assert model.decode_batch(sentences, K) == expected
+    # 只出现在词内的字也保留了单字词频数，逐字的路径始终有有限代价
+    assert model.inference(["a", "a"]) and model.inference(["zhuai"])
+
+def test_word_readings():
+    from models import WordModel
+    model = WordModel.__new__(WordModel)
+    # 两字词的全部读音组合都在，首字的读音同样会变化
+    assert sorted(model.word_readings([["hang", "xing"], ["hang", "xing"]])) == \
+        [("hang", "hang"), ("hang", "xing"), ("xing", "hang"), ("xing", "xing")]
+    long = model.word_readings([["a", "b"]] * 6)
+    assert len(long) == WordModel.MAX_READINGS and long[0] == ("a",) * 6
+    assert all(any(syllables[i] == "b" for syllables in long) for i in range(6))
+
+def test_unreachable_layer(model_dir):
+    # 三元模型中“dia”的候选字都接不上时整层为空：各解码路径都返回 []，而不是抛出 IndexError
+    pytest.importorskip("numpy")
+    model = TripleModel(K, 0.99999, 0.9, 1000000, model_dir)
+    sentence = "wo dia men".split()
+    model.reset()
+    assert model.inference(sentence) == []
+    assert model.decode_batch([sentence, ["wo", "men"]], K) == [[], model.decode_batch([["wo", "men"]], K)[0]]
+    assert NumpyDecoder(model).inference(sentence) == BeamDecoder(model).inference(sentence) == []
+    session = model.session()
+    for pinyin in sentence:
+        session.push(pinyin)
+    assert session.candidates() == []
+
+def test_decode_batch_stats(model_dir, sentences):
+    # --batch-size 与 --profile 同用时，批量解码也要统计句数并计时 transition / total 阶段
+    model = BinaryModel(K, 0.99999, 1000000, model_dir)
+    stats = model.enable_stats()
+    model.decode_batch(sentences + [[]], K)
+    model.enable_stats(False)
+    summary = stats.summary()
+    assert summary["sentences"] == len(sentences)
+    assert summary["layers"] == sum(len(sentence) + 1 for sentence in sentences)
+    assert 0 < stats.times["transition"] <= summary["total_s"]
@@ -0,0 +1,102 @@
+from collections import defaultdict
+import pytest
+import benchmark
+import dataprocess as dp
+from store import NgramStore
+
+KEYS = ["title", "html"]
+
+def reference_counts(corpus, chars):
+    ids = {c: i for i, c in enumerate(chars)}
+    uni, bi, tri = defaultdict(int), defaultdict(int), defaultdict(int)
+    for text in dp.iter_corpus_texts(corpus, KEYS, "gbk"):
+        dp.count_ngrams(text, ids, uni, bi, tri)
+    return uni, bi, tri
+
+def run_counts(runs):
+    return dict(dp.merge_runs([dp.run_stream(run) for run in runs]))
+
+def nested(tables):
+    # 把各构建方式的结果统一成去掉 0 计数的普通嵌套 dict
+    char_table, binary_table, triple_table = tables
+    return ({c: n for c, n in char_table.items() if n}, \
+            {a: dict(row) for a, row in binary_table.items() if row}, \
+            {a: {b: dict(row) for b, row in rows.items() if row} for a, rows in triple_table.items() if rows})
+
+def to_tables(chars, uni, bi, tri):
+    char_table = dict.fromkeys(chars, 0)
+    binary_table = defaultdict(lambda: defaultdict(int))
+    triple_table = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
+    dp.apply_counts(chars, uni, bi, tri, char_table, binary_table, triple_table)
+    char_table.pop('<start>')
+    return nested((char_table, binary_table, triple_table))
+
+@pytest.fixture(scope="module")
+def expected(corpus, chars):
+    return to_tables(chars, *reference_counts(corpus, chars))
+
+@pytest.fixture
+def char_freq_table(chars):
+    # 两遍构建与并行构建从模块级的 CHAR_FREQ_TABLE 取字表并在其中累加字频
+    dp.CHAR_FREQ_TABLE.clear()
+    dp.CHAR_FREQ_TABLE.update(dict.fromkeys(chars[:-2], 0))
+    yield dp.CHAR_FREQ_TABLE
+    dp.CHAR_FREQ_TABLE.clear()
+
+def test_legacy_builder(corpus, chars, expected):
+    char_table = dict.fromkeys(chars[:-2], 0)
+    binary_table, triple_table = benchmark.legacy_freq_tables(corpus, KEYS, "gbk", char_table)
+    assert nested((char_table, binary_table, triple_table)) == expected
+
+def test_two_pass_builders(corpus, expected, char_freq_table):
+    binary_table = dp.build_binary_freq_table(corpus, KEYS, "gbk", defaultdict(lambda: defaultdict(int)))
+    triple_table = dp.build_triple_freq_table(corpus, KEYS, "gbk", defaultdict(lambda: defaultdict(lambda: defaultdict(int))))
+    assert nested((char_freq_table, binary_table, triple_table)) == expected
+
+def test_parallel_build(corpus, expected, char_freq_table, tmp_path):
+    size = corpus.stat().st_size
+    chars, uni, bi, tri = dp.build_freq_tables_parallel([corpus], KEYS, "gbk", 2, tmp_path / "shards", size // 5 + 1)
+    assert to_tables(chars, uni, bi, tri) == expected
+    assert not (tmp_path / "shards").exists()
+
+def test_streaming_build(corpus, chars, expected, tmp_path):
+    unigram, bi_runs, tri_runs = dp.count_corpus_streaming([corpus], KEYS, "gbk", chars, tmp_path, 1 << 20)
+    uni = {i: count for i, count in enumerate(unigram) if count}
+    assert to_tables(chars, uni, run_counts(bi_runs), run_counts(tri_runs)) == expected
+
+def test_incremental_update_matches_full_build(corpus, chars, tmp_path):
+    lines = corpus.read_bytes().splitlines(keepends=True)
+    corpus_dir = tmp_path / "corpus"
+    corpus_dir.mkdir()
+    first, second = corpus_dir / "a.txt", corpus_dir / "b.txt"
+    first.write_bytes(b"".join(lines[:len(lines) // 2]))
+    second.write_bytes(b"".join(lines[len(lines) // 2:]))
+
+    def build(files, data_path):
+        unigram, bi_runs, tri_runs = dp.count_corpus_streaming(files, KEYS, "gbk", chars, data_path / "spill", 1 << 20)
+        store, = dp.build_stores_from_runs(chars, unigram, [dp.run_stream(run) for run in bi_runs], \
+                                           [dp.run_stream(run) for run in tri_runs])
+        return store
+
+    data_path = tmp_path / "model"
+    data_path.mkdir()
+    build([first], data_path).save(data_path / "ngram_store.bin")
+    dp.save_manifest(data_path, {dp.file_digest(first): first.name})
+    assert dp.update_store(data_path, [first, second], KEYS, "gbk", 1 << 20) is not None
+    assert dp.update_store(data_path, [first, second], KEYS, "gbk", 1 << 20) is None
+    assert not list(data_path.glob("*.pk"))
+    updated = NgramStore.open(data_path / "ngram_store.bin")
+    full = build([first, second], tmp_path)
+    assert updated.chars == full.chars
+    for name in ("unigram", "bi_offsets", "bi_keys", "bi_counts", "tri_offsets", "tri_keys", "tri_counts"):
+        assert list(getattr(updated, name)) == list(getattr(full, name))
+
+def test_streaming_spills_under_small_budget(corpus, chars, tmp_path):
+    uni, bi, tri = reference_counts(corpus, chars)
+    unigram, bi_runs, tri_runs = dp.count_corpus_streaming([corpus], KEYS, "gbk", chars, tmp_path, 1000)
+    assert len(bi_runs) > 3 and len(tri_runs) > 3
+    for run in bi_runs + tri_runs:
+        assert len(dp.open_model_file(run)["keys"]) <= 1500
+    assert run_counts(bi_runs) == bi
+    assert run_counts(tri_runs) == tri
+    assert {i: count for i, count in enumerate(unigram) if count} == uni
@@ -0,0 +1,29 @@
+import pinyin
+from models import BinaryModel
+
+def test_empty_lattice_scores_as_wrong(model_dir):
+    model = BinaryModel(3, 0.99999, 1000000, model_dir)
+    decode = pinyin.make_decoder(model, segment=True)
+    results = decode(["v", "123", "womenv", "women"])
+    assert results[:3] == [[], [], []]
+    assert results[3]
+    assert pinyin.score(results[0], "我们") == [0, 0, 0, 2, 1]
+    assert pinyin.score([], "") == [0, 0, 0, 0, 1]
+    assert pinyin.format_results([], 1) == pinyin.format_results([], 3) == ""
+
+def test_spelled_input_has_no_abbreviation_edges(model_dir):
+    model = BinaryModel(3, 0.99999, 1000000, model_dir)
+    for text in ("qinghuadaxue", "womenshi", "xi'an"):
+        edges = model.syllables.lattice(text)
+        assert not any(abbreviated for row in edges for _, _, abbreviated in row)
+    assert model.decode_lattice("qinghuadaxue") == model.inference("qing hua da xue".split())
+    # 只有完整音节切不通的片段才加缩写边
+    edges = model.syllables.lattice("women xh")
+    assert not any(abbreviated for row in edges[:5] for _, _, abbreviated in row)
+    assert any(abbreviated for _, _, abbreviated in edges[5])
+
+def test_abbreviations_switch(model_dir):
+    model = BinaryModel(3, 0.99999, 1000000, model_dir)
+    assert model.decode_lattice("qhdx")
+    decode = pinyin.make_decoder(model, segment=True, abbreviations=False)
+    assert decode(["qhdx", "qinghuadaxue"]) == [[], model.decode_lattice("qinghuadaxue")]
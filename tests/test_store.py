@@ -0,0 +1,122 @@
+import math
+import struct
+from array import array
+import pytest
+import store
+from store import NgramStore, CompiledStore, write_model_file, open_model_file
+
+CHAR_TABLE = {"清": 5, "华": 4, "大": 7, "学": 6, "<start>": 5}
+BINARY_TABLE = {"<start>": {"清": 3, "大": 2}, "清": {"华": 4}, "华": {"大": 3, "<end>": 1}, "大": {"学": 6}, "学": {"<end>": 5}}
+TRIPLE_TABLE = {"<start>": {"清": {"华": 3}, "大": {"学": 2}}, "清": {"华": {"大": 3}}, "华": {"大": {"学": 3}}, "大": {"学": {"<end>": 5}}}
+
+def table_store():
+    return NgramStore.from_tables(CHAR_TABLE, BINARY_TABLE, TRIPLE_TABLE)
+
+def test_model_file_sections_round_trip(tmp_path):
+    sections = {"text": "清华\0大学".encode("utf8"), "small": array('H', [0, 1, 65535]), "counts": array('q', [1 << 40, 0, 7]), \
+                "costs": array('d', [0.5, math.inf]), "codes": array('B', [0, 255])}
+    write_model_file(tmp_path / "model.bin", sections)
+    loaded = open_model_file(tmp_path / "model.bin")
+    assert list(loaded) == list(sections)
+    assert bytes(loaded["text"]) == sections["text"]
+    for name in ("small", "counts", "costs", "codes"):
+        assert loaded[name].format == sections[name].typecode
+        assert list(loaded[name]) == list(sections[name])
+    assert not list(tmp_path.glob("*.tmp"))
+
+def test_model_file_rejects_foreign_files(tmp_path):
+    (tmp_path / "other.bin").write_bytes(b"NOTAFILE" + bytes(64))
+    with pytest.raises(ValueError, match="not a PinyinIME model file"):
+        open_model_file(tmp_path / "other.bin")
+    write_model_file(tmp_path / "model.bin", {"x": array('q', [1])})
+    data = bytearray((tmp_path / "model.bin").read_bytes())
+    struct.pack_into("<I", data, 8, store.FORMAT_VERSION + 1)
+    (tmp_path / "model.bin").write_bytes(bytes(data))
+    with pytest.raises(ValueError, match="format version"):
+        open_model_file(tmp_path / "model.bin")
+
+def test_store_round_trip_keeps_counts(tmp_path):
+    table = table_store()
+    table.save(tmp_path / "ngram_store.bin")
+    mapped = NgramStore.open(tmp_path / "ngram_store.bin")
+    assert mapped.chars == table.chars
+    assert mapped.fingerprint() == table.fingerprint()
+    for name in ("unigram", "bi_offsets", "bi_keys", "bi_counts", "tri_offsets", "tri_keys", "tri_counts"):
+        assert list(getattr(mapped, name)) == list(getattr(table, name))
+    for char, count in CHAR_TABLE.items():
+        assert mapped.unigram_count(char) == count
+    for first, row in BINARY_TABLE.items():
+        for second, count in row.items():
+            assert mapped.bigram_count(first, second) == count
+    for first, rows in TRIPLE_TABLE.items():
+        for second, row in rows.items():
+            for third, count in row.items():
+                assert mapped.trigram_count(first, second, third) == count
+    assert mapped.bigram_count("学", "清") == 0
+    assert mapped.trigram_context_total("<start>", "清") == 3
+
+def test_store_sections_use_narrow_types(tmp_path):
+    table = table_store()
+    table.bi_counts[0] = 1 << 20
+    table.save(tmp_path / "ngram_store.bin")
+    sections = open_model_file(tmp_path / "ngram_store.bin")
+    assert sections["bi_keys"].format == "H"
+    assert sections["bi_counts"].format == "I"
+    assert NgramStore.open(tmp_path / "ngram_store.bin").bi_counts[0] == 1 << 20
+
+def test_synthetic_store_round_trip(model_dir, tmp_path):
+    built = NgramStore.open(model_dir / "ngram_store.bin")
+    built.save(tmp_path / "ngram_store.bin")
+    assert (tmp_path / "ngram_store.bin").read_bytes() == (model_dir / "ngram_store.bin").read_bytes()
+
+@pytest.mark.parametrize("bits", [0, 8, 16])
+def test_compiled_store_round_trip(tmp_path, bits):
+    table = table_store()
+    compiled = CompiledStore.compile(table, 0.9, 0.8, 100)
+    if bits:
+        compiled = compiled.quantize(bits)
+    compiled.save(tmp_path / "compiled_store.bin")
+    mapped = CompiledStore.open(tmp_path / "compiled_store.bin", table)
+    assert mapped.matches(0.9, 0.8, 100, bits)
+    assert not mapped.matches(0.9, 0.8, 100, 8 if bits != 8 else 16)
+    for name in store.COST_TABLES:
+        assert list(getattr(mapped, name)) == list(getattr(compiled, name))
+
+def test_compiled_store_rejects_other_store(tmp_path):
+    table = table_store()
+    CompiledStore.compile(table, 0.9, 0.8, 100).save(tmp_path / "compiled_store.bin")
+    other = NgramStore.from_tables(CHAR_TABLE, BINARY_TABLE)
+    with pytest.raises(ValueError, match="different n-gram store"):
+        CompiledStore.open(tmp_path / "compiled_store.bin", other)
+
+def test_compiled_store_rejects_same_shape_store(tmp_path):
+    table = table_store()
+    CompiledStore.compile(table, 0.9, 0.8, 100).save(tmp_path / "compiled_store.bin")
+    binary_table = {first: dict(row) for first, row in BINARY_TABLE.items()}
+    binary_table["清"]["华"] += 1
+    other = NgramStore.from_tables(CHAR_TABLE, binary_table, TRIPLE_TABLE)
+    assert len(other.bi_keys) == len(table.bi_keys) and list(other.unigram) == list(table.unigram)
+    with pytest.raises(ValueError, match="different n-gram store"):
+        CompiledStore.open(tmp_path / "compiled_store.bin", other)
+
+def test_load_compiled_writes_back(tmp_path, capsys):
+    table = table_store()
+    table.save(tmp_path / "ngram_store.bin")
+    table = NgramStore.open(tmp_path / "ngram_store.bin")
+    store.load_compiled(tmp_path, table, 0.9, 0.8, 100, 8)
+    assert CompiledStore.open(tmp_path / "compiled_store.bin", table).matches(0.9, 0.8, 100, 8)
+    store.load_compiled(tmp_path, table, 0.9, 0.8, 100, 8)
+    assert "Warning" not in capsys.readouterr().err
+    store.load_compiled(tmp_path, table, 0.5, 0.8, 100, 8)
+    assert "Warning" in capsys.readouterr().err
+    assert CompiledStore.open(tmp_path / "compiled_store.bin", table).matches(0.5, 0.8, 100, 8)
+
+def test_triple_rows_match_triple_cost():
+    table = table_store()
+    compiled = CompiledStore.compile(table, 0.9, 0.8, 100)
+    ids = table.ids
+    cs = [ids.get(char, -1) for char in ("清", "华", "大", "学", "<end>", "无")]
+    for a in range(len(table.chars)):
+        for b in range(-1, len(table.chars)):
+            row = compiled.triple_row(table.bigram_index(a, b), cs, compiled.backoff_row(b, cs))
+            assert row == [compiled.triple_cost(a, b, c) for c in cs]